@@ -0,0 +1,202 @@
+# ----------------------------------------------------------------------------
+#
+# -- mudblood - a flexible mud client --
+#
+# aiotelnet.py
+#
+# Telnet client on top of asyncio transports. TelnetProtocol parses incoming
+# data with the same parser as telnet.Telnet and emits the same events, but
+# it is driven by an asyncio event loop instead of a thread per socket.
+#
+# This is a library for headless and automated sessions on Python 3 (e.g.
+# bots or load tests that feed a Drain); the client itself does not use it.
+# Requires Python 3.4 or later.
+#
+# ----------------------------------------------------------------------------
+
+import asyncio
+import threading
+from collections import deque
+
+from mudblood import event
+from mudblood import telnet
+
+class TransportWriter(object):
+    """
+    File-like writer for an asyncio transport. Writes may come from any
+    thread. While the transport has paused us (its buffer is above the high
+    water mark), data is kept in a local backlog and written when the
+    transport resumes.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.paused = False
+        self.backlog = deque()
+        self.backlogSize = 0
+        self.waiters = []
+        # Ident of the thread running the loop, set when connected
+        self.thread = None
+
+    def write(self, data):
+        data = bytes(data)
+        if self.thread is None or self.thread == threading.current_thread().ident:
+            self.doWrite(data)
+        else:
+            self.loop.call_soon_threadsafe(self.doWrite, data)
+
+    def doWrite(self, data):
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.paused or self.backlog:
+            self.backlog.append(data)
+            self.backlogSize += len(data)
+        else:
+            self.transport.write(data)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        while self.backlog and not self.paused:
+            data = self.backlog.popleft()
+            self.backlogSize -= len(data)
+            self.transport.write(data)
+
+        if not self.paused:
+            waiters, self.waiters = self.waiters, []
+            for w in waiters:
+                if not w.done():
+                    w.set_result(None)
+
+    def writable(self):
+        """
+        Return a future that completes as soon as writing is not paused
+        anymore. Use it to throttle bulk writes.
+        """
+        f = self.loop.create_future()
+        if self.paused or self.backlog:
+            self.waiters.append(f)
+        else:
+            f.set_result(None)
+        return f
+
+    def bufferSize(self):
+        """
+        Return the number of bytes waiting to be sent, both in our backlog
+        and in the transport's buffer.
+        """
+        size = self.backlogSize
+        if self.transport is not None:
+            size += self.transport.get_write_buffer_size()
+        return size
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+class TelnetProtocol(telnet.Telnet, asyncio.Protocol):
+    """
+    An asyncio protocol that speaks telnet. Like telnet.Telnet, it is a
+    source that must be bound to a drain and it provides sendIAC,
+    sendSubneg, sendGMCP and sendNaws.
+    """
+    def __init__(self, loop, fastParser=True):
+        super(TelnetProtocol, self).__init__(TransportWriter(loop), fastParser)
+        self.loop = loop
+
+    def connection_made(self, transport):
+        self.file.transport = transport
+        self.file.thread = threading.current_thread().ident
+        self.running = True
+
+    def data_received(self, data):
+        self.parse(data)
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.running = False
+        if exc is not None:
+            self.put(event.LogEvent("Telnet: Connection lost: {}".format(exc), "err"))
+        self.put(event.DisconnectEvent())
+
+    def pause_writing(self):
+        self.file.pause()
+
+    def resume_writing(self):
+        self.file.resume()
+
+    def writable(self):
+        return self.file.writable()
+
+    def bufferSize(self):
+        return self.file.bufferSize()
+
+    # TelnetProtocol is driven by the loop, it has no thread of its own.
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.running = False
+        self.loop.call_soon_threadsafe(self.file.close)
+
+def connect(loop, drain, host, port, fastParser=True):
+    """
+    Connect to host:port. Must be called from the loop's thread. Return a
+    future that resolves to the bound TelnetProtocol.
+    """
+    proto = TelnetProtocol(loop, fastParser)
+    proto.bind(drain)
+
+    ret = loop.create_future()
+
+    def done(task):
+        if task.cancelled():
+            ret.cancel()
+        elif task.exception() is not None:
+            ret.set_exception(task.exception())
+        else:
+            ret.set_result(proto)
+
+    loop.create_task(loop.create_connection(lambda: proto, host, port)).add_done_callback(done)
+    return ret
+
+class LoopThread(object):
+    """
+    Runs an asyncio event loop in a background thread so that any number of
+    TelnetProtocols can be served without a thread per connection.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        # Let closing transports run their callbacks before closing the loop
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def connect(self, drain, host, port, timeout=None):
+        """
+        Connect from another thread. Blocks until the connection is
+        established and returns the TelnetProtocol.
+        """
+        proto = TelnetProtocol(self.loop)
+        proto.bind(drain)
+        f = asyncio.run_coroutine_threadsafe(
+                self.loop.create_connection(lambda: proto, host, port), self.loop)
+        f.result(timeout)
+        return proto
@@ -1,3 +1,5 @@
+import threading
+
 from mudblood.colors import AString
 from mudblood import colors
 
@@ -113,3 +115,29 @@ class Ansi(FSM):
                 elif d >= 40 and d <= 47:
                     self.attr = (self.attr[0], d - 40, self.attr[2])
             return "end"
+
+class LineCache(object):
+    """
+    Caches the parsed AString of a line. The line is only parsed again when
+    it changes, and only the new part is parsed when it grows by appending
+    (e.g. while a partial line streams in). parse() returns a copy, so
+    callers may modify it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.text = ""
+        # Parser state after parsing text
+        self.parser = Ansi()
+        self.astring = AString()
+
+    def parse(self, text):
+        with self.lock:
+            if text != self.text:
+                if text.startswith(self.text):
+                    self.astring += self.parser.parseToAString(text[len(self.text):])
+                else:
+                    self.parser.reset()
+                    self.astring = self.parser.parseToAString(text)
+                self.text = text
+
+            return AString(self.astring)
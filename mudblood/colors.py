@@ -80,6 +80,17 @@ class AString(object):
     def __len__(self):
         return len(self.string)
     
+    def strip(self):
+        """
+        Return a copy without leading and trailing whitespace.
+        """
+        start, end = 0, len(self.string)
+        while start < end and self.string[start][1].isspace():
+            start += 1
+        while end > start and self.string[end - 1][1].isspace():
+            end -= 1
+        return AString(self.string[start:end])
+
     def toString(self):
         return self.__str__()
 
@@ -11,69 +11,366 @@
 # ----------------------------------------------------------------------------
 
 import threading
+import time
 from collections import deque
 
 import sys
 
 import socket
 
+from mudblood import trace
+from mudblood.timers import clock
+
+# Priority lanes of a Drain, highest priority first. Every event class names
+# its lane in the class attribute 'lane'.
+LANE_INPUT = 0      # Keyboard input and UI requests
+LANE_CONTROL = 1    # Logging, quit and everything else
+LANE_NETWORK = 2    # Bulk data from the server
+
+LANES = ["input", "control", "network"]
+
 class Drain(object):
     """
     This is the consumer object. Sources can bind themselves to a Drain
     which can consume the events from the sources.
+
+    Events are queued in priority lanes. The consumer always gets the oldest
+    event of the highest priority lane, unless the oldest event of a lower
+    lane has waited more than agingLimit seconds longer than that one. Then
+    the lower lane comes first, so a flood in one lane cannot starve the
+    others, and events never overtake older events of a higher lane.
+
+    If coalesce is set, a RawEvent that is put while the newest event of its
+    lane is a RawEvent from the same source is appended to that one instead
+    of being queued. Telnet and GMCP events share the lane, so nothing is
+    merged across them.
+
+    Sources that run in their own thread can bypass the drain's lock with a
+    Channel (see openChannel). The consumer moves channel events into the
+    lanes when it consumes.
     """
-    def __init__(self):
-        self.eventQueue = deque()
+    # Coalesced RawEvents do not grow beyond this many bytes
+    MAX_COALESCE = 65536
+
+    def __init__(self, agingLimit=0.1, coalesce=False):
+        # One deque of (time, event) tuples per lane. put() appends on the
+        # left, consumers pop on the right.
+        self.lanes = [deque() for l in LANES]
         self.condition = threading.Condition()
+        self.agingLimit = agingLimit
+        self.coalesce = coalesce
+
+        # Per lane: number of consumed and coalesced events, maximal queue
+        # depth, total and maximal time in the queue
+        self.stats = [{"events": 0, "coalesced": 0, "maxDepth": 0, "totalWait": 0.0, "maxWait": 0.0}
+                      for l in LANES]
+
+        # Open channels. Replaced (not modified) on change, so the consumer
+        # can iterate it without the lock.
+        self.channels = []
+
+        # Set while the consumer sleeps, either in wait() or somewhere else
+        # (e.g. in a reactor). For the latter, waker() is called when a
+        # thread other than consumer enqueues an event during the sleep.
+        self.sleeping = False
+        self.waker = None
+        self.consumer = None
+
+    def empty(self):
+        if self.queued():
+            return False
+        for ch in self.channels:
+            if ch.head != ch.tail:
+                return False
+        return True
+
+    def queued(self):
+        """
+        Return True if an event is waiting in the lanes (channels are not
+        checked).
+        """
+        for q in self.lanes:
+            if q:
+                return True
+        return False
+
+    def wait(self, timeout):
+        # Producers check sleeping after they queued something, so it must
+        # be set before the drain is checked.
+        self.sleeping = True
+        try:
+            while self.empty():
+                self.condition.wait(timeout)
+                if timeout is not None:
+                    break
+        finally:
+            self.sleeping = False
 
-    def get(self, block=True, timeout=None):
+    def wakeConsumer(self):
         """
-        Consume a single event from the end of the queue.
+        Wake up the consumer if it is sleeping.
         """
-        ev = None
+        with self.condition:
+            self.condition.notify()
+        if self.waker is not None and threading.current_thread() is not self.consumer:
+            self.waker()
 
-        self.condition.acquire()
-        try:
-            ev = self.eventQueue.pop()
-            self.condition.release()
-            return ev
-        except IndexError:
-            if not block:
-                self.condition.release()
+    def take(self, now):
+        """
+        Pop the next event according to the lane priorities. The condition
+        must be held and the drain must not be empty.
+        """
+        # A lower lane only goes first if its oldest event has waited
+        # agingLimit longer than the oldest event of the lane it overtakes.
+        lane = None
+        for i, q in enumerate(self.lanes):
+            if q:
+                t = q[-1][0]
+                if lane is None or head - t > self.agingLimit:
+                    lane, head = i, t
+
+        t, ev = self.lanes[lane].pop()
+
+        stats = self.stats[lane]
+        wait = now - t
+        stats["events"] += 1
+        stats["totalWait"] += wait
+        if wait > stats["maxWait"]:
+            stats["maxWait"] = wait
+        return ev
+
+    def get(self, block=True, timeout=None):
+        """
+        Consume a single event.
+        """
+        with self.condition:
+            if block:
+                self.wait(timeout)
+            self.collect()
+            if not self.queued():
                 return None
-            while True:
-                self.condition.wait(timeout)
-                try:
-                    ev = self.eventQueue.pop()
-                    self.condition.release()
-                    return ev
-                except IndexError:
-                    if timeout is not None:
-                        self.condition.release()
-                        return None
+            ev = self.take(clock())
 
-    def put(self, event):
+        if trace.tracer is not None:
+            trace.tracer.stamp(ev, "queue")
+        return ev
+
+    def getBatch(self, maxN=None, block=True, timeout=None):
         """
-        Called by sources to append something to the front of the queue.
+        Consume up to maxN events (all pending events if maxN is None) with
+        a single lock acquisition. If the drain is empty, wait like get().
+        Return a list of events in the order they would have been consumed
+        by get().
         """
-        self.condition.acquire()
+        with self.condition:
+            if block:
+                self.wait(timeout)
+            self.collect()
+
+            now = clock()
+            ret = []
+            while (maxN is None or len(ret) < maxN) and self.queued():
+                ret.append(self.take(now))
+
+        if trace.tracer is not None:
+            for ev in ret:
+                trace.tracer.stamp(ev, "queue")
+        return ret
+
+    def drainAll(self):
+        """
+        Consume all pending events without blocking.
+        """
+        return self.getBatch(None, False)
 
-        self.eventQueue.appendleft(event)
+    def laneStats(self):
+        """
+        Return a dict with the metrics of every lane: current and maximal
+        queue depth, number of consumed and coalesced events and the
+        average and maximal waiting time in seconds.
+        """
+        ret = {}
+        with self.condition:
+            for i, name in enumerate(LANES):
+                stats = self.stats[i]
+                ret[name] = {"depth": len(self.lanes[i]),
+                             "maxDepth": stats["maxDepth"],
+                             "events": stats["events"],
+                             "coalesced": stats["coalesced"],
+                             "avgWait": stats["totalWait"] / stats["events"] if stats["events"] else 0.0,
+                             "maxWait": stats["maxWait"]}
+        return ret
+
+    def enqueue(self, event, front):
+        item = (clock(), event)
 
+        self.condition.acquire()
+        self.insert(item, front)
         self.condition.notify()
         self.condition.release()
 
+        if self.waker is not None and self.sleeping and threading.current_thread() is not self.consumer:
+            self.waker()
+
+    def insert(self, item, front):
+        """
+        Queue a (time, event) tuple in its lane. The condition must be held.
+        """
+        event = item[1]
+        lane = getattr(event, "lane", LANE_CONTROL)
+        q = self.lanes[lane]
+
+        if front:
+            q.append(item)
+        elif self.coalesce and type(event) is RawEvent and q and self.merge(q[0][1], event):
+            self.stats[lane]["coalesced"] += 1
+        else:
+            q.appendleft(item)
+
+        if len(q) > self.stats[lane]["maxDepth"]:
+            self.stats[lane]["maxDepth"] = len(q)
+
+    def insertAll(self, items):
+        """
+        Queue a list of (time, event) tuples like insert() without
+        coalescing. The condition must be held.
+        """
+        lanes = self.lanes
+        for item in items:
+            lanes[getattr(item[1], "lane", LANE_CONTROL)].appendleft(item)
+
+        for i, q in enumerate(lanes):
+            if len(q) > self.stats[i]["maxDepth"]:
+                self.stats[i]["maxDepth"] = len(q)
+
+    def openChannel(self, capacity=None):
+        """
+        Create a Channel that feeds this drain. It must only be written to
+        by a single thread.
+        """
+        ch = Channel(self, capacity or Channel.CAPACITY)
+        with self.condition:
+            self.channels = self.channels + [ch]
+        return ch
+
+    def collect(self):
+        """
+        Move the events of all channels into their lanes and forget closed
+        channels once they are empty. The condition must be held.
+        """
+        done = False
+        for ch in self.channels:
+            if ch.head != ch.tail:
+                items = ch.takeAll()
+                if self.coalesce:
+                    for item in items:
+                        self.insert(item, False)
+                else:
+                    self.insertAll(items)
+            if ch.closed and ch.head == ch.tail:
+                done = True
+
+        if done:
+            self.channels = [ch for ch in self.channels if not (ch.closed and ch.head == ch.tail)]
+
+    def merge(self, queued, event):
+        """
+        Append a RawEvent to a queued one, if possible. Return True if it
+        was merged.
+        """
+        if (type(queued) is not RawEvent or queued.prompt or queued.source is not event.source
+                or len(queued.data) + len(event.data) > self.MAX_COALESCE):
+            return False
+
+        queued.data = queued.data + event.data
+        queued.prompt = event.prompt
+        return True
+
+    def put(self, event):
+        """
+        Called by sources to append something to the front of its lane.
+        """
+        self.enqueue(event, False)
+
     def push(self, event):
         """
-        Called by sources to append something to the end of the queue.
-        I.e.: The pushed event will be the next consumed event.
+        Called by sources to append something to the end of its lane.
+        I.e.: The pushed event will be the next consumed event of its lane.
         """
-        self.condition.acquire()
+        self.enqueue(event, True)
 
-        self.eventQueue.append(event)
+class Channel(object):
+    """
+    A ring buffer that hands events from a single producer thread to the
+    consumer of a Drain without the drain's lock. Only the producer writes
+    head, only the consumer writes tail, and the GIL keeps each of these
+    steps atomic. The consumer is only woken up while it is sleeping.
+    """
+    CAPACITY = 4096
 
-        self.condition.notify()
-        self.condition.release()
+    def __init__(self, drain, capacity=CAPACITY):
+        self.drain = drain
+        # One slot stays free to tell a full ring from an empty one
+        self.size = capacity + 1
+        self.ring = [None] * self.size
+        self.head = 0
+        self.tail = 0
+        self.closed = False
+        # Number of times the producer had to wait for room
+        self.stalls = 0
+
+    def __len__(self):
+        return (self.head - self.tail) % self.size
+
+    def put(self, event):
+        """
+        Producer side: queue an event. Blocks while the ring is full.
+        """
+        head = self.head
+        following = head + 1
+        if following == self.size:
+            following = 0
+
+        if following == self.tail:
+            # Full: yield to the consumer, then back off
+            self.stalls += 1
+            self.drain.wakeConsumer()
+            spins = 0
+            while following == self.tail:
+                time.sleep(0 if spins < 100 else 0.001)
+                spins += 1
+
+        self.ring[head] = (clock(), event)
+        self.head = following
+
+        if self.drain.sleeping:
+            self.drain.wakeConsumer()
+
+    def takeAll(self):
+        """
+        Consumer side: remove and return all queued (time, event) tuples.
+        """
+        ring = self.ring
+        tail = self.tail
+        head = self.head
+
+        if tail <= head:
+            ret = ring[tail:head]
+            ring[tail:head] = [None] * (head - tail)
+        else:
+            ret = ring[tail:] + ring[:head]
+            ring[tail:] = [None] * (self.size - tail)
+            ring[:head] = [None] * head
+
+        self.tail = head
+        return ret
+
+    def close(self):
+        """
+        Producer side: no more events will follow. The drain forgets the
+        channel once it is empty.
+        """
+        self.closed = True
 
 # ----------------------------------------------------------------------------
 #   EVENT TYPES
@@ -83,33 +380,55 @@ class Drain(object):
 
 class Event(object):
     """
-    Base class for all events.
+    Base class for all events. Events declare their attributes in __slots__,
+    so they carry no instance dict.
     """
+    __slots__ = ("source", "continuation", "trace")
+
+    lane = LANE_CONTROL
+
     def __init__(self):
         # The source of the event
         self.source = None
         # A function that is called after the event was processed
         self.continuation = None
+        # Stage stamps while tracing is enabled (see trace.py)
+        self.trace = None
+
+    def fields(self):
+        """
+        Return a dict of all attributes of this event, except for the
+        trace stamps.
+        """
+        ret = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if name != "trace" and hasattr(self, name):
+                    ret[name] = getattr(self, name)
+        return ret
 
 class DisconnectEvent(Event):
     """
     Signals that a session has closed its connection.
     Emitted by: Session
     """
-    pass
+    __slots__ = ()
+    lane = LANE_NETWORK
 
 class QuitEvent(Event):
     """
     Requests mudblood to quit.
     Emitted by: Session
     """
-    pass
+    __slots__ = ()
 
 class LogEvent(Event):
     """
     Adds a message to the log console.
     Emitted by: *
     """
+    __slots__ = ("msg", "level")
+
     def __init__(self, msg, level="info"):
         super(LogEvent, self).__init__()
         self.msg = msg
@@ -120,6 +439,9 @@ class KeyEvent(Event):
     Signals that a key has been pressed.
     Emitted by: Screen
     """
+    __slots__ = ("key",)
+    lane = LANE_INPUT
+
     def __init__(self, key):
         super(KeyEvent, self).__init__()
         self.key = key
@@ -132,6 +454,9 @@ class KeystringEvent(Event):
     Signals that a line of input was received.
     Emitted by: Screen
     """
+    __slots__ = ("keystring",)
+    lane = LANE_INPUT
+
     def __init__(self, keystring):
         super(KeystringEvent, self).__init__()
         self.keystring = keystring
@@ -144,6 +469,9 @@ class ResizeEvent(Event):
     Signals that the screen size has changed.
     Emitted by: Screen
     """
+    __slots__ = ("w", "h")
+    lane = LANE_INPUT
+
     def __init__(self, w, h):
         super(ResizeEvent, self).__init__()
         self.w = w
@@ -154,6 +482,9 @@ class GridResizeEvent(Event):
     Signals that the screen size has changed.
     Emitted by: Screen
     """
+    __slots__ = ("w", "h")
+    lane = LANE_INPUT
+
     def __init__(self, w, h):
         super(GridResizeEvent, self).__init__()
         self.w = w
@@ -164,6 +495,9 @@ class ModeEvent(Event):
     Requests to change screen mode.
     Emitted by: Session
     """
+    __slots__ = ("mode", "args")
+    lane = LANE_INPUT
+
     def __init__(self, mode, **kwargs):
         super(ModeEvent, self).__init__()
         self.mode = mode
@@ -172,11 +506,16 @@ class ModeEvent(Event):
 class RawEvent(Event):
     """
     Incoming data from a telnet socket, already stripped of Telnegs.
+    If prompt is set, the data is followed by a GA or EOR.
     Emitted by: Telnet
     """
-    def __init__(self, data):
+    __slots__ = ("data", "prompt")
+    lane = LANE_NETWORK
+
+    def __init__(self, data, prompt=False):
         super(RawEvent, self).__init__()
         self.data = data
+        self.prompt = prompt
     
     def __repr__(self):
         return "RawEvent: {}".format(self.data)
@@ -186,12 +525,18 @@ class InputEvent(Event):
     A line of input was made or the lua function send() was called.
     Emitted by: Session, Screen
     """
+    __slots__ = ("text", "display")
+    lane = LANE_INPUT
+
     def __init__(self, text, display=True):
         super(InputEvent, self).__init__()
         self.text = text
         self.display = display
 
 class LuaEvent(Event):
+    __slots__ = ("code",)
+    lane = LANE_INPUT
+
     def __init__(self, code):
         super(LuaEvent, self).__init__()
         self.code = code
@@ -201,11 +546,68 @@ class CallableEvent(Event):
     A callable should be called with the given arguments.
     Emitted by: *
     """
+    __slots__ = ("call", "args")
+    lane = LANE_INPUT
+
     def __init__(self, call, *args):
         super(CallableEvent, self).__init__()
         self.call = call
         self.args = args
 
+# ----------------------------------------------------------------------------
+#   DISPATCH
+# ----------------------------------------------------------------------------
+
+class Dispatcher(object):
+    """
+    Maps event classes to handler functions. A handler registered for a
+    class also receives events of its subclasses, unless a subclass has a
+    handler of its own. Lookups are cached per class.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.cache = {}
+
+    def register(self, cls, handler):
+        """
+        Call handler(ev) for events of class cls. Replaces an existing
+        handler for cls.
+        """
+        self.handlers[cls] = handler
+        self.cache = {}
+
+    def unregister(self, cls):
+        self.handlers.pop(cls, None)
+        self.cache = {}
+
+    def lookup(self, cls):
+        """
+        Return the handler for events of class cls or None.
+        """
+        try:
+            return self.cache[cls]
+        except KeyError:
+            pass
+
+        handler = None
+        for c in cls.__mro__:
+            if c in self.handlers:
+                handler = self.handlers[c]
+                break
+
+        self.cache[cls] = handler
+        return handler
+
+    def dispatch(self, ev):
+        """
+        Pass an event to its handler. Return False if there is none.
+        """
+        handler = self.lookup(type(ev))
+        if handler is None:
+            return False
+        handler(ev)
+        return True
+
 # ----------------------------------------------------------------------------
 #   SOURCE TYPES
 # 
@@ -237,6 +639,8 @@ class Source(object):
         """
         if not event.source:
             event.source = self
+        if trace.tracer is not None:
+            trace.tracer.put(event)
         if self.drain:
             self.drain.put(event)
 
@@ -246,6 +650,8 @@ class Source(object):
         """
         if not event.source:
             event.source = self
+        if trace.tracer is not None:
+            trace.tracer.put(event)
         if self.drain:
             self.drain.push(event)
 
@@ -1,6 +1,5 @@
 import os
 import lupa
-import codecs
 import traceback
 
 from mudblood import linebuffer
@@ -11,6 +10,8 @@ from mudblood import colors
 from mudblood import ansi
 from mudblood import flock
 from mudblood import telnet
+from mudblood import trace
+from mudblood import timers
 
 class Lua(object):
     def __init__(self, session, packagePath):
@@ -31,6 +32,13 @@ class Lua(object):
 
         self.lua = lupa.LuaRuntime()
 
+        # GMCP package name (lower case) -> list of Lua handlers
+        self.gmcpSubscriptions = {}
+
+        # Trigger list kind -> Lua table of that kind's lists of all
+        # contexts. Cleared whenever a context is reset.
+        self.listCache = {}
+
         g = self.lua.globals()
 
         g.package.path = self.packagePath
@@ -38,6 +46,8 @@ class Lua(object):
         self.tryExecute("colors = require 'colors'")
         self.tryExecute("events = require 'events'")
         self.tryExecute("triggers = require 'triggers'")
+        g.triggers.clock = timers.clock
+        g.triggers.wakeAt = self.wakeAt
         self.tryExecute("mapper = require 'mapper'")
         self.tryExecute("require 'help'")
 
@@ -50,6 +60,7 @@ class Lua(object):
         g.quit = self.session.quit
         g.mode = self.mode
         g.connect = self.connect
+        g.replay = self.session.replay
         setattr(g, "print", self.echo)
         g.status = self.session.status
         g.send = self.send
@@ -60,6 +71,7 @@ class Lua(object):
         g.load = self.load
         g.config = self.config
         g.editor = self.editor
+        g.traceDump = self.traceDump
         g.path = Lua_Path(self)
         g.profile = self.profile
         g.listProfiles = self.listProfiles
@@ -69,6 +81,12 @@ class Lua(object):
 
         g.markPrompt = self.markPrompt
 
+        g.openSession = self.openSession
+        g.switchSession = self.switchSession
+        g.closeSession = self.closeSession
+        g.sessionList = self.sessionList
+        g.currentSession = self.currentSession
+
         g.screen = self.session.master.screen.getLuaScreen(self)
 
     def destroy(self):
@@ -110,23 +128,64 @@ class Lua(object):
     def hook(self, hook, *args):
         return self.lua.globals().events.call(hook, self.lua.table(*args))
 
+    def hasHook(self, hook):
+        return self.lua.globals().events.registered(hook)
+
+    def gmcpHandlers(self, module):
+        """
+        Return all handlers subscribed to a GMCP module or to one of its
+        parent packages.
+        """
+        ret = []
+        name = module.lower()
+        while True:
+            ret.extend(self.gmcpSubscriptions.get(name, []))
+            if name == "":
+                break
+            name = name.rpartition(".")[0]
+        return ret
+
+    def triggerLists(self, kind):
+        """
+        Return a Lua table with the trigger lists of the given kind (e.g.
+        'recvTriggers') of the prompt, room and global context.
+        """
+        ret = self.listCache.get(kind)
+        if ret is None:
+            g = self.lua.globals()
+            ret = self.lua.table(getattr(g.ctxPrompt, kind), getattr(g.ctxRoom, kind), getattr(g.ctxGlobal, kind))
+            self.listCache[kind] = ret
+        return ret
+
     def triggerSend(self, line):
         g = self.lua.globals()
-        g.triggers.queryListsAndSend.coroutine(
-                self.lua.table(g.ctxPrompt.sendTriggers, g.ctxRoom.sendTriggers, g.ctxGlobal.sendTriggers),
-                line).send(None)
+        g.triggers.queryListsAndSend.coroutine(self.triggerLists("sendTriggers"), line).send(None)
     
     def triggerRecv(self, line):
         g = self.lua.globals()
-        g.triggers.queryListsAndEcho.coroutine(
-                self.lua.table(g.ctxPrompt.recvTriggers, g.ctxRoom.recvTriggers, g.ctxGlobal.recvTriggers),
-                line).send(None)
+        g.triggers.queryListsAndEcho.coroutine(self.triggerLists("recvTriggers"), line).send(None)
+
+    def triggerRecvLines(self, lines):
+        """
+        Query the recv triggers with a list of lines in one Lua call.
+        Return a list of error messages of lines whose triggers failed.
+        """
+        g = self.lua.globals()
+        errors = g.triggers.queryListsAndEchoAll.coroutine(
+                self.triggerLists("recvTriggers"), self.lua.table(*lines)).send(None)
+        if errors is None:
+            return []
+        return list(errors.values())
 
     def triggerBlock(self, line):
         g = self.lua.globals()
-        g.triggers.queryLists.coroutine(
-                self.lua.table(g.ctxPrompt.blockTriggers, g.ctxRoom.blockTriggers, g.ctxGlobal.blockTriggers),
-                line).send(None)
+        return g.triggers.queryLists.coroutine(self.triggerLists("blockTriggers"), line).send(None)
+
+    def wakeAt(self, deadline):
+        """
+        Query the timers when triggers.clock() reaches deadline.
+        """
+        self.session.master.timers.add(deadline, self.session.timerDeadline)
 
     def triggerTime(self):
         g = self.lua.globals()
@@ -214,10 +273,34 @@ class Lua(object):
     def config(self, key, value):
         if key == "encoding":
             try:
-                codecs.lookup(value)
-                self.session.encoding = value
+                self.session.setEncoding(value)
             except:
                 self.error("Encoding {} not supported".format(value))
+        elif key == "mccp":
+            self.session.mccp = bool(value)
+        elif key == "record":
+            self.session.recordFile = value
+        elif key == "latency":
+            self.session.setLatencyInterval(value)
+        elif key == "nativePrompt":
+            self.session.setNativePrompt(bool(value))
+        elif key == "streamBlocks":
+            self.session.streamBlocks = bool(value)
+        elif key == "coalesce":
+            self.session.master.drain.coalesce = bool(value)
+        elif key == "trace":
+            if value:
+                trace.enable()
+            else:
+                trace.disable()
+
+    def traceDump(self, filename=None):
+        if trace.tracer is None:
+            self.error("Tracing is disabled. Use config('trace', true).")
+
+        if filename is None:
+            return trace.tracer.report()
+        trace.tracer.dump(filename)
 
     def editor(self, content, callback):
         self.session.put(event.ModeEvent("editor", content=content, callback=callback))
@@ -226,6 +309,36 @@ class Lua(object):
         self.session.markPrompt()
         self.lua.globals().ctxPrompt.reset()
 
+    def sessionByIndex(self, index):
+        sessions = list(self.session.master.sessions)
+        if index is None:
+            return self.session
+        if not 1 <= index <= len(sessions):
+            self.error("No session {}".format(index))
+        return sessions[index - 1]
+
+    def openSession(self, profile=None):
+        manager = self.session.master.sessions
+        manager.open(profile)
+        return len(manager)
+
+    def switchSession(self, index):
+        self.session.master.sessions.switch(self.sessionByIndex(index))
+
+    def closeSession(self, index=None):
+        s = self.sessionByIndex(index)
+        if s.telnet is not None:
+            self.error("Session {} is still connected".format(s.name))
+        if len(self.session.master.sessions) == 1:
+            self.error("Cannot close the last session")
+        self.session.master.sessions.close(s)
+
+    def sessionList(self):
+        return self.lua.table(*[s.name for s in self.session.master.sessions])
+
+    def currentSession(self):
+        return list(self.session.master.sessions).index(self.session.master.session) + 1
+
     def profile(self, name=None):
         if name is None:
             name = self.currentProfile
@@ -254,6 +367,46 @@ class LuaExposedObject(object):
     def __repr__(self):
         return self.__str__()
 
+class Lua_HeadlessScreen(LuaExposedObject):
+    """
+    The screen object for sessions without a user interface (see
+    record.HeadlessScreen). Nothing is drawn, the screen only remembers
+    what it was told.
+    """
+    def __init__(self, lua, screen):
+        super(Lua_HeadlessScreen, self).__init__(lua)
+        self._screen = screen
+
+    def windowVisible(self, name, value=None):
+        if value is None:
+            return name == 'main' or name in self._screen.windows
+        if value:
+            self._screen.windows.add(name)
+        else:
+            self._screen.windows.discard(name)
+
+    def windowSize(self, name, value=None):
+        if value is None:
+            return self._screen.window_sizes.get(name)
+        self._screen.window_sizes[name] = value
+
+    def height(self):
+        return self._screen.height
+
+    def width(self):
+        return self._screen.width
+
+    def scroll(self, value, name='main'):
+        pass
+
+    def fps(self, value=None):
+        if value is None:
+            return self._screen.fps
+        self._screen.fps = value
+
+    def frameStats(self):
+        return self._lua.lua.table()
+
 class Lua_Profile(LuaExposedObject):
     def __init__(self, lua, path):
         super(Lua_Profile, self).__init__(lua)
@@ -289,6 +442,7 @@ class Lua_Context(LuaExposedObject):
         self.reset()
 
     def reset(self):
+        self._lua.listCache.clear()
         self.sendTriggers = self._lua.lua.globals().triggers.TriggerList.create()
         self.recvTriggers = self._lua.lua.globals().triggers.TriggerList.create()
         self.blockTriggers = self._lua.lua.globals().triggers.TriggerList.create()
@@ -325,6 +479,7 @@ class Lua_Telnet(LuaExposedObject):
     OPT_EOR = 25
     OPT_NAWS = 31
     OPT_LINEMODE = 34
+    OPT_MCCP2 = 86
 
     def negWill(self, option):
         if not self._lua.session.telnet: raise Exception("Not connected")
@@ -342,6 +497,49 @@ class Lua_Telnet(LuaExposedObject):
         if not self._lua.session.telnet: raise Exception("Not connected")
         self._lua.session.telnet.sendSubneg(option, data)
 
+    def mccpStats(self):
+        """
+        Return a table with MCCP2 statistics: active, compressed,
+        decompressed, ratio and saved.
+        """
+        if not self._lua.session.telnet: raise Exception("Not connected")
+        t = self._lua.session.telnet
+        compressed, decompressed, ratio, saved = t.compressionStats()
+        return self._lua.lua.table(active=(t.decompressor is not None),
+                                   compressed=compressed,
+                                   decompressed=decompressed,
+                                   ratio=ratio,
+                                   saved=saved)
+
+    def writeStats(self):
+        """
+        Return a table with outbound queue statistics: pending writes and
+        bytes, total writes, flushes and bytes, and the last and maximum
+        flush latency in seconds.
+        """
+        if not self._lua.session.telnet: raise Exception("Not connected")
+        t = self._lua.session.telnet
+        pending, pendingBytes = t.queueDepth()
+        return self._lua.lua.table(pending=pending, pendingBytes=pendingBytes, **t.writeStats)
+
+    def latency(self):
+        """
+        Return a table with round trip statistics of TIMING-MARK pings
+        (count, min, avg, p99, last) and the client-side lag, all in seconds.
+        """
+        return self._lua.session.latency()
+
+    def gmcpSubscribe(self, package, fun):
+        """
+        Call fun(module, data) for every GMCP message of the given package
+        or one of its sub-packages. Messages nobody subscribed to are never
+        decoded.
+        """
+        self._lua.gmcpSubscriptions.setdefault(package.lower(), []).append(fun)
+
+    def gmcpUnsubscribe(self, package):
+        self._lua.gmcpSubscriptions.pop(package.lower(), None)
+
     def gmcpObject(self, module, ob):
         if not self._lua.session.telnet: raise Exception("Not connected")
         self._lua.session.telnet.sendGMCP(telnet.GMCPEvent(module=module, obj=dict(ob)))
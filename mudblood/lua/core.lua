@@ -11,6 +11,14 @@ if false then
     -- @tparam number port The port to be used.
     function connect(host, port) end
 
+    --- Replay a recording made with config("record", filename).
+    -- The recorded server output is fed into the session as if it came from
+    -- the network. If we are still connected, this function does nothing.
+    -- @tparam string filename The recording to replay.
+    -- @tparam boolean realtime If true, keep the recorded timing. Otherwise
+    --                          replay as fast as possible.
+    function replay(filename, realtime) end
+
     --- Set the status line
     -- @tparam string status The new status line.
     function status(status) end
@@ -42,6 +50,20 @@ if false then
     --- Set a configuration option.
     -- Possible keys are:
     -- - encoding: 'utf8', 'ascii', 'latin1' etc.
+    -- - mccp: true to accept MCCP2 compression (default), false to refuse it.
+    -- - record: A filename. Raw traffic of the next connection is recorded there.
+    -- - latency: Send a TIMING-MARK ping every n seconds (nil to stop). Every
+    --   answer calls the 'latency' event with the table from telnet.latency().
+    -- - nativePrompt: true to mark prompts on GA and EOR without a telneg
+    --   event. The 'prompt' event is called afterwards with the prompt line.
+    -- - streamBlocks: true to query block triggers after every line with the
+    --   lines received since the last prompt (or the last match), instead of
+    --   once at the prompt. A match starts a new block. The line passed to
+    --   the triggers grows in place, so copy it (tostring) to keep it.
+    -- - coalesce: true to merge chunks of server output that queue up while
+    --   the client is busy, so triggers run on fewer, larger chunks.
+    -- - trace: true to record latency histograms of the event pipeline, see
+    --   traceDump().
     -- @tparam string key The name of the option.
     -- @param value The desired new value.
     function config(key, value) end
@@ -68,12 +90,44 @@ if false then
     -- @treturn RPCObject
     function rpcClient(type, address) end
 
+    --- Report the latencies recorded since config("trace", true).
+    -- For every event type, the report lists the time spent in the queue,
+    -- until dispatch, in Lua triggers and until the screen showed it.
+    -- @tparam string filename If given, write the report to this file.
+    -- @treturn string The report, if no filename was given.
+    function traceDump(filename) end
+
     --- Spawn an editor.
     -- @tparam string content The initial contents of the editor.
     -- @treturn string The final contents of the editor.
     function editor(content) end
 
+    --- Start a new session with its own connection and Lua state.
+    -- The new session runs in the background until it is switched to.
+    -- @tparam string profile The profile to load (optional).
+    -- @treturn number The number of the new session.
+    function openSession(profile) end
+
+    --- Show another session on the screen. Keys and input go to that
+    -- session from now on.
+    -- @tparam number index The number of the session, see sessionList().
+    -- @usage nmap("<F2>", function () switchSession(2) end)
+    function switchSession(index) end
+
+    --- Close a disconnected session. The last session cannot be closed.
+    -- @tparam number index The number of the session (default: this one).
+    function closeSession(index) end
+
+    --- Return the profile names of all sessions, by session number.
+    -- @treturn table The names.
+    function sessionList() end
+
+    --- Return the number of the session on the screen.
+    -- @treturn number The session number.
+    function currentSession() end
+
     --- Mark current line as a prompt.
     -- Meant to be called e.g. when an EOR or GA telneg is received.
+    -- With config("nativePrompt", true), this happens automatically.
     function markPrompt() end
 end
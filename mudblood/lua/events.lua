@@ -10,13 +10,19 @@ local events = {
     heartbeat = {},
     room = {},
     telneg = {},
-    gmcp = {}
+    gmcp = {},
+    latency = {},
+    prompt = {}
 }
 
 function M.register(name, fun)
     table.insert(events[name], fun)
 end
 
+function M.registered(name)
+    return #events[name] > 0
+end
+
 function M.call(name, arg)
     local ret = nil
     for k,v in ipairs(events[name]) do
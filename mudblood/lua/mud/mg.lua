@@ -147,12 +147,21 @@ function M.base.setup()
             telnet.negDo(telnet.OPT_EOR)
         elseif cmd == telnet.WILL and option == 201 then
             M.gmcp.setup()
-        elseif cmd == telnet.EOR then
-            tlRecvVolatile:clear()
-            markPrompt()
         end
     end)
 
+    -- Prompts are marked on EOR by mudblood itself
+    config("nativePrompt", true)
+    events.register("prompt", function ()
+        tlRecvVolatile:clear()
+    end)
+
+    -- Round trip time of TIMING-MARK pings
+    events.register("latency", function (l)
+        M.base.status.latency = string.format("%dms (lag %dms) | ", math.floor(l.avg * 1000), math.floor(l.lag * 1000))
+        M.base.status.update()
+    end)
+
     -- Logging
     M.base.logfd = assert(io.open(path.profile() .. "/log", "a"))
 
@@ -193,19 +202,21 @@ end)
 M.base.status = {}
 M.base.status.report = ""
 M.base.status.mapper = ""
+M.base.status.latency = ""
 
 function M.base.status.update()
     padding = ""
-    for i=0,(screen.width() - #M.base.status.report - 53) do
+    for i=0,(screen.width() - #M.base.status.report - #M.base.status.latency - 53) do
         padding = padding .. " "
     end
 
-    status(string.format("%s%-10.10s %s#%-5.5d %s%-10.10s %s%-20.20s%s %s",
+    status(string.format("%s%-10.10s %s#%-5.5d %s%-10.10s %s%-20.20s%s %s%s",
                          colors.Red,                        M.mapper.mode,
                          colors.Green,                      map.room().id,
                          colors.Red,                        map.room().getUserdata("tag"),
                          colors.Green,                      map.room().getUserdata("hash"),
-                         colors.Off .. padding,             M.base.status.report))
+                         colors.Off .. padding,             M.base.status.latency,
+                                                            M.base.status.report))
 end
 
 -- Report
@@ -288,7 +299,7 @@ M.gmcp = {}
 M.gmcp.active = false
 
 function M.gmcp.setup()
-    events.register("gmcp", function (mod, data)
+    local function onGmcp(mod, data)
         if mod == "MG.char.base" then
             M.stats.name = data['name']
             M.stats.guild = data['guild']
@@ -370,7 +381,11 @@ function M.gmcp.setup()
         end
 
         M.onReport()
-    end)
+    end
+
+    telnet.gmcpSubscribe("MG.char", onGmcp)
+    telnet.gmcpSubscribe("comm.channel", onGmcp)
+    telnet.gmcpSubscribe("MG.room", onGmcp)
 
     telnet.negDo(201)
     telnet.gmcpObject("Core.Hello", {client="mudblood", version="0.1"})
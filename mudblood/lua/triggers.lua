@@ -285,6 +285,26 @@ function M.queryListsAndEcho(lists, al)
     return true
 end
 
+--- Query trigger lists with a number of lines, like queryListsAndEcho.
+-- Every line runs in its own coroutine, so a trigger that suspends while
+-- handling one line does not hold up the following lines. An error in one
+-- line does not stop the following lines either.
+-- @tparam table lists The trigger lists.
+-- @tparam table lines The lines.
+-- @treturn table The error messages.
+function M.queryListsAndEchoAll(lists, lines)
+    local errors = {}
+    for _, al in ipairs(lines) do
+        local ret, err = coroutine.resume(coroutine.create(M.queryListsAndEcho), lists, al)
+        if ret == false then
+            table.insert(errors, tostring(err))
+        end
+    end
+    return errors
+end
+
+--- Query trigger lists without echoing the line.
+-- @treturn boolean True if a trigger fired or gagged the line.
 function M.queryLists(lists, al)
     local l = tostring(al)
     local gr2 = false
@@ -302,7 +322,7 @@ function M.queryLists(lists, al)
         if r3 then gr3 = true end
     end
     mapper.V()
-    return true
+    return gr2
 end
 
 --- String representation of the TriggerList.
@@ -505,14 +525,15 @@ end
 
 --- Wait for a certain amount of time and then call a function.
 -- @tparam string desc The trigger's description
--- @tparam number length Number of seconds to wait. Note that this is quite
---                       imprecise for now with an error of about +/- 1 second
+-- @tparam number length Number of seconds to wait. Fractions of a second are
+--                       allowed.
 -- @tparam function f The function to call
 -- @treturn Trigger
 function M.timer(desc, length, f)
-    local endtime = os.time() + length
+    local endtime = M.clock() + length
+    M.wakeAt(endtime)
     return M.Trigger.create(desc, function (self)
-            if os.time() >= endtime then
+            if M.clock() >= endtime then
                 if f then f() end
                 return nil, true, true
             end
@@ -527,13 +548,20 @@ end
 -- @treturn M.Trigger
 -- @see triggers.timer
 function M.repeat_timer(desc, length, f)
-    local endtime = os.time() + length
+    local endtime = M.clock() + length
+    M.wakeAt(endtime)
     return M.Trigger.create(desc, function (self)
-            if os.time() > endtime then
+            local now = M.clock()
+            if now >= endtime then
                 if f() == true then
                     return nil, true, true
                 else
                     endtime = endtime + length
+                    if endtime <= now then
+                        -- Skip periods we missed instead of firing repeatedly
+                        endtime = now + length
+                    end
+                    M.wakeAt(endtime)
                     return nil, true, false
                 end
             end
@@ -542,6 +570,21 @@ function M.repeat_timer(desc, length, f)
     )
 end
 
+--- Timer support.
+-- Timers are only queried when a deadline registered with wakeAt() has
+-- passed. Custom timer triggers must register their deadlines, too.
+-- @section timers
+
+--- Return the current time of the monotonic clock in seconds.
+-- @function clock
+-- @treturn number
+
+--- Query the timers as soon as clock() reaches deadline.
+-- @function wakeAt
+-- @tparam number deadline A time as returned by clock()
+
+--- @section end
+
 --- Trigger fragments.
 -- @section fragments
 
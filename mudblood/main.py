@@ -2,6 +2,7 @@ import sys
 import os
 import time
 import argparse
+import threading
 import traceback
 
 screens = ['tbscreen', 'ttyscreen', 'wxscreen', 'pgscreen'];
@@ -13,12 +14,31 @@ def main():
     parser.add_argument("-i", metavar="interface", action='store',
             choices=screens,
             default='default', help="The interface to use (default: termbox)")
-    parser.add_argument("script", action='store', nargs='?',
-            help="The main script")
+    parser.add_argument("--reactor", action='store_true',
+            help="Poll all sockets from a single network thread")
+    parser.add_argument("--single", action='store_true',
+            help="Run network, input and drawing on the main thread (termbox and tty interfaces)")
+    parser.add_argument("--workers", action='store_true',
+            help="Run every session in its own process. The Lua screen object forwards window changes to the interface; the map and frameStats() are not available.")
+    parser.add_argument("--batch", metavar="size", type=int, default=1024,
+            help="Maximum number of events to process between screen updates (0: unlimited)")
+    parser.add_argument("--coalesce", action='store_true',
+            help="Merge consecutive chunks of server output while they are queued")
+    parser.add_argument("--trace", metavar="file", default=None,
+            help="Trace event latencies and write a report to file on exit")
+    parser.add_argument("script", action='store', nargs='*',
+            help="The main script. Every further script is started in its own session.")
     options = parser.parse_args()
 
     config = {
-            "script": options.script
+            "script": options.script[0] if options.script else None,
+            "scripts": options.script[1:],
+            "reactor": options.reactor,
+            "single": options.single,
+            "workers": options.workers,
+            "batch": options.batch,
+            "trace": options.trace,
+            "coalesce": options.coalesce
             }
 
     Mudblood(options.i).run(config)
@@ -27,12 +47,26 @@ from mudblood import event
 from mudblood import session
 from mudblood import linebuffer
 from mudblood import window
+from mudblood import reactor
+from mudblood import trace
+from mudblood import timers
 
 class Mudblood(object):
     def __init__(self, screenType):
-        self.session = None
+        self.sessions = session.SessionManager(self)
+        self.reactor = None
+        self.singleThreaded = False
         self.drain = event.Drain()
+        self.timers = timers.TimerHeap()
         self.screenType = screenType
+
+        self.dispatcher = event.Dispatcher()
+        self.dispatcher.register(event.LogEvent, lambda ev: self.log(ev.msg, ev.level))
+        self.dispatcher.register(event.KeyEvent, lambda ev: self.screen.key(ev.key))
+        self.dispatcher.register(event.KeystringEvent, lambda ev: self.screen.keystring(ev.keystring))
+        self.dispatcher.register(event.ResizeEvent, lambda ev: self.screen.updateSize(ev.w, ev.h))
+        self.dispatcher.register(event.ModeEvent, lambda ev: self.screen.setMode(ev.mode, **ev.args))
+        self.dispatcher.register(event.CallableEvent, self.callableEvent)
         self.path = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
     def run(self, config):
@@ -48,6 +82,15 @@ class Mudblood(object):
                 break
         else:
             screenModule = getattr(__import__('mudblood.screen.'+self.screenType, globals(), locals(), [], -1).screen, self.screenType)
+
+        # In single threaded mode, the main loop polls all sources with the
+        # reactor. The screen must be told before it creates its input source.
+        if config.get('single'):
+            self.reactor = reactor.Reactor()
+            self.singleThreaded = True
+            self.drain.waker = self.reactor.wake
+            self.drain.consumer = threading.current_thread()
+
         self.screen = screenModule.createScreen(self)
 
         self.screen.bind(self.drain)
@@ -65,70 +108,126 @@ class Mudblood(object):
             except:
                 raise Exception("Could not create configuration directory.")
 
-        self.session = session.Session(self, config['script'])
-        self.session.bind(self.drain)
-        self.session.start()
+        if config.get('trace'):
+            trace.enable()
+
+        self.drain.coalesce = bool(config.get('coalesce'))
+
+        if self.singleThreaded and not self.screen.inline:
+            self.log("Interface {} does not support --single".format(self.screenType), "warn")
+            self.singleThreaded = False
+            self.drain.waker = None
+            self.reactor.start()
+        elif config.get('reactor') and self.reactor is None:
+            self.reactor = reactor.Reactor()
+            self.reactor.start()
+
+        self.sessions.workers = bool(config.get('workers'))
+        self.sessions.open(config['script'])
+        for script in config.get('scripts', []):
+            self.sessions.open(script)
 
         self.screen.updateScreen()
 
+        batchSize = config.get('batch') or None
+
         doQuit = False
-        while not doQuit:
-            needUpdate = False
-
-            # Process all pending events, then update screen
-            ev = self.drain.get(True, 1)
-            if ev:
-                if isinstance(ev, event.QuitEvent):
-                    doQuit = True
-                else:
-                    self.event(ev)
-                    needUpdate = True
-            while True:
-                ev = self.drain.get(False)
-                if ev is None:
-                    break
-                if isinstance(ev, event.QuitEvent):
-                    doQuit = True
+        try:
+            while not doQuit:
+                needUpdate = False
+
+                # Process a batch of pending events, then update screen. Sleep
+                # until the next event or the next timer deadline.
+                if self.singleThreaded:
+                    evs = self.pollOnce(batchSize)
                 else:
-                    self.event(ev)
+                    evs = self.drain.getBatch(batchSize, True, self.timers.timeout())
+
+                for ev in evs:
+                    if isinstance(ev, event.QuitEvent):
+                        doQuit = True
+                    elif self.event(ev):
+                        needUpdate = True
+
+                if self.timers.expire() > 0 and self.sessions.triggerTime():
                     needUpdate = True
+                self.sessions.flush()
+
+                if self.singleThreaded:
+                    self.screen.runPending()
 
-            self.session.lua.triggerTime()
+                if needUpdate:
+                    self.screen.updateScreen()
 
-            if needUpdate:
-                self.screen.updateScreen()
+                if self.singleThreaded and self.screen.frames.pending and self.screen.frames.delay() == 0:
+                    self.screen.drawFrame()
 
-            self.screen.tick()
+                self.screen.tick()
 
-            # TODO: multiple sessions
-        self.log("Goodbye", "info")
-            
-        self.screen.destroy()
+            self.log("Goodbye", "info")
+        finally:
+            # Leave the terminal usable even if the main loop dies
+            self.screen.destroy()
         self.screen.join()
 
-        self.session.destroy()
+        self.sessions.destroy()
+
+        if config.get('trace') and trace.tracer is not None:
+            trace.tracer.dump(config['trace'])
+
+        if self.reactor is not None:
+            self.reactor.stop()
+
+    def pollOnce(self, batchSize):
+        """
+        Single threaded mode: Wait until an input source or a socket is
+        readable, a timer expires or a pending frame is due, poll the
+        readable sources and return a batch of pending events.
+        """
+        timeout = self.timers.timeout()
+        if self.screen.frames.pending:
+            delay = self.screen.frames.delay()
+            timeout = delay if timeout is None else min(timeout, delay)
+
+        # Other threads wake the reactor while sleeping is set (see Drain)
+        self.drain.sleeping = True
+        if not self.drain.empty() or not self.screen.queue.empty():
+            timeout = 0
+        try:
+            self.reactor.runOnce(timeout)
+        finally:
+            self.drain.sleeping = False
+
+        return self.drain.getBatch(batchSize, False)
+
+    def getSession(self):
+        """
+        The active session, i.e. the one on the screen.
+        """
+        return self.sessions.active
+
+    session = property(getSession)
 
     def event(self, ev):
+        """
+        Handle an event. Return True if the screen may have changed.
+        """
         #if not isinstance(ev, event.RawEvent):
         #    self.log(str(ev), "debug3")
 
-        if isinstance(ev, event.LogEvent):
-            self.log(ev.msg, ev.level)
-        elif isinstance(ev, event.KeyEvent):
-            self.screen.key(ev.key)
-        elif isinstance(ev, event.KeystringEvent):
-            self.screen.keystring(ev.keystring)
-        elif isinstance(ev, event.ResizeEvent):
-            self.screen.updateSize(ev.w, ev.h)
-        elif isinstance(ev, event.ModeEvent):
-            self.screen.setMode(ev.mode, **ev.args)
-        elif isinstance(ev, event.CallableEvent):
-            try:
-                ev.call(*ev.args)
-            except Exception as e:
-                self.log("{}\n{}".format(str(e), traceback.format_exc()), "err")
-        else:
-            self.session.event(ev)
+        trace.stamp(ev, "dispatch")
+
+        # Everything the master does not handle itself goes to the session
+        # it belongs to
+        if self.dispatcher.dispatch(ev):
+            return True
+        return self.sessions.event(ev)
+
+    def callableEvent(self, ev):
+        try:
+            ev.call(*ev.args)
+        except Exception as e:
+            self.log("{}\n{}".format(str(e), traceback.format_exc()), "err")
 
     def log(self, msg, level="debug"):
         if level == "debug3":
@@ -0,0 +1,186 @@
+# ----------------------------------------------------------------------------
+#
+# -- mudblood - a flexible mud client --
+#
+# reactor.py
+#
+# This module implements a network reactor that multiplexes any number of
+# AsyncSources (telnet connections, RPC sockets) on a single thread. Instead
+# of blocking in its own thread, each source is polled by the reactor as
+# soon as its file descriptor becomes readable.
+#
+# ----------------------------------------------------------------------------
+
+import os
+import errno
+import select
+import threading
+from collections import namedtuple
+
+from mudblood import event
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+EVENT_READ = 1
+
+SelectorKey = namedtuple("SelectorKey", ["fileobj", "fd", "events", "data"])
+
+class SelectSelector(object):
+    """
+    A minimal stand-in for selectors.SelectSelector on Pythons that lack
+    the selectors module.
+    """
+    def __init__(self):
+        self.keys = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self.keys[fd] = SelectorKey(fileobj, fd, events, data)
+        return self.keys[fd]
+
+    def unregister(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        return self.keys.pop(fd)
+
+    def select(self, timeout=None):
+        try:
+            r, _, _ = select.select(list(self.keys.keys()), [], [], timeout)
+        except (select.error, EnvironmentError) as e:
+            # A signal (e.g. SIGWINCH on resize) interrupted the wait. On
+            # Python 2, select.error is no EnvironmentError.
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [(self.keys[fd], EVENT_READ) for fd in r if fd in self.keys]
+
+    def close(self):
+        self.keys = {}
+
+def createSelector():
+    if selectors is not None:
+        return selectors.DefaultSelector()
+    else:
+        return SelectSelector()
+
+class Reactor(object):
+    """
+    Polls a number of sources from a single thread. A source must provide
+    fileno() and a poll() that does not block once its file descriptor is
+    readable. Sources keep their event contract: poll() puts events into
+    the source's drain exactly like in the source's own thread.
+    """
+    def __init__(self):
+        self.selector = createSelector()
+        self.sources = {}
+        self.pending = []
+        self.lock = threading.Lock()
+
+        # Self-pipe to interrupt select() when sources are added or removed
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.selector.register(self.wakeRead, EVENT_READ, None)
+
+        self.thread = None
+        self.running = False
+
+    def add(self, source):
+        """
+        Start polling a source. Replaces source.start().
+        """
+        source.running = True
+        with self.lock:
+            self.pending.append((True, source))
+        self.wake()
+
+    def remove(self, source):
+        """
+        Stop polling a source. Replaces source.stop().
+        """
+        source.running = False
+        with self.lock:
+            self.pending.append((False, source))
+        self.wake()
+
+    def wake(self):
+        os.write(self.wakeWrite, b"x")
+
+    def start(self):
+        """
+        Run the reactor in its own thread.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            self.runOnce()
+
+    def runOnce(self, timeout=None):
+        """
+        Wait until at least one source is readable (or the timeout expires)
+        and poll all readable sources once.
+        Return the number of sources polled.
+        """
+        self.applyPending()
+
+        n = 0
+        for key, mask in self.selector.select(timeout):
+            if key.data is None:
+                os.read(self.wakeRead, 4096)
+                continue
+
+            source = key.data
+            if not source.running:
+                continue
+
+            try:
+                ev = source.poll()
+            except EnvironmentError as e:
+                # A connection reset must not take the other sources down
+                ev = self.fail(source, e)
+            if ev:
+                source.put(ev)
+            n += 1
+
+            if not source.running:
+                self.unregister(source)
+
+        return n
+
+    def fail(self, source, error):
+        """
+        Stop polling a source whose poll() raised and return the
+        DisconnectEvent that ends its session.
+        """
+        source.running = False
+        source.put(event.LogEvent("Connection lost: {}".format(error), "err"))
+        return event.DisconnectEvent()
+
+    def applyPending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+
+        for add, source in pending:
+            if add:
+                self.sources[source.fileno()] = source
+                self.selector.register(source.fileno(), EVENT_READ, source)
+            else:
+                self.unregister(source)
+
+    def unregister(self, source):
+        for fd, s in list(self.sources.items()):
+            if s is source:
+                del self.sources[fd]
+                self.selector.unregister(fd)
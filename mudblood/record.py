@@ -0,0 +1,236 @@
+# ----------------------------------------------------------------------------
+#
+# -- mudblood - a flexible mud client --
+#
+# record.py
+#
+# Recording and replay of raw session traffic. A recording contains every
+# chunk read from the server socket together with a monotonic timestamp, so
+# it can be fed into telnet.Telnet again without a network, either in real
+# time or as fast as possible.
+#
+# File format: The magic line MAGIC, followed by records. Every record is a
+# header RECORD (seconds since start of recording as a double and length of
+# the chunk) followed by the chunk itself.
+#
+# Run this module to benchmark the pipeline with a recording:
+#
+#   python -m mudblood.record recording.mbr [--realtime] [--profile PROFILE]
+#
+# ----------------------------------------------------------------------------
+
+import sys
+import time
+import struct
+import argparse
+
+from mudblood import event
+from mudblood import telnet
+from mudblood import timers
+from mudblood.timers import clock
+
+MAGIC = b"MBREC1\n"
+RECORD = struct.Struct("!dI")
+
+class InvalidRecordingException(Exception):
+    pass
+
+class Recorder(object):
+    """
+    Writes chunks with timestamps to a recording file.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.file.write(MAGIC)
+        self.start = clock()
+
+    def record(self, data):
+        if self.file is None:
+            return
+        self.file.write(RECORD.pack(clock() - self.start, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class RecordingSocket(object):
+    """
+    Wraps a TCPSocket and records everything that is read from it.
+    """
+    def __init__(self, sock, recorder):
+        self.sock = sock
+        self.recorder = recorder
+
+    def connect(self, host, port):
+        self.sock.connect(host, port)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def getBuffer(self):
+        return self.sock.buffer
+
+    buffer = property(getBuffer)
+
+    def read(self, size):
+        ret = self.sock.read(size)
+        if ret is None:
+            self.recorder.close()
+        else:
+            self.recorder.record(ret)
+        return ret
+
+    def readInto(self):
+        n = self.sock.readInto()
+        if n is None:
+            self.recorder.close()
+        else:
+            self.recorder.record(self.sock.view[:n].tobytes())
+        return n
+
+    def write(self, string):
+        self.sock.write(string)
+
+class ReplayFile(object):
+    """
+    A file object that replays a recording. read() returns the recorded
+    chunks one by one, regardless of the requested size, so the parser sees
+    the same chunk boundaries as during recording. With realtime set, read()
+    sleeps until the chunk's timestamp (divided by speed) has passed.
+    Everything written is discarded.
+    """
+    def __init__(self, filename, realtime=False, speed=1.0):
+        self.file = open(filename, "rb")
+        if self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise InvalidRecordingException("{} is not a mudblood recording".format(filename))
+
+        self.realtime = realtime
+        self.speed = speed
+        self.start = None
+        self.written = 0
+
+    def read(self, size):
+        header = self.file.read(RECORD.size)
+        if len(header) < RECORD.size:
+            self.file.close()
+            return None
+
+        timestamp, length = RECORD.unpack(header)
+        data = self.file.read(length)
+
+        if self.realtime:
+            if self.start is None:
+                self.start = clock() - timestamp / self.speed
+            delay = self.start + timestamp / self.speed - clock()
+            if delay > 0:
+                time.sleep(delay)
+
+        return data
+
+    def write(self, string):
+        self.written += len(string)
+
+class HeadlessScreen(object):
+    """
+    Screen replacement for sessions that run without a user interface.
+    It keeps the grid size and the window layout set from Lua.
+    """
+    def __init__(self, width=80, height=24):
+        self.logbuffer = []
+        self.width = width
+        self.height = height
+        self.windows = set()
+        self.window_sizes = {}
+        self.fps = None
+
+    def getLuaScreen(self, luaob):
+        from mudblood import lua
+        return lua.Lua_HeadlessScreen(luaob, self)
+
+    def log(self, text):
+        self.logbuffer.append(text)
+
+class HeadlessMaster(object):
+    """
+    Master replacement that lets a Session run without Mudblood's main loop.
+    """
+    def __init__(self):
+        self.screen = HeadlessScreen()
+        self.drain = event.Drain()
+        self.timers = timers.TimerHeap()
+        self.session = None
+        self.reactor = None
+
+def benchmark(filename, realtime=False, profile=None):
+    """
+    Replay a recording through the pipeline and return a dict of
+    measurements. Without a profile, only the telnet parser and the drain
+    are measured. With a profile, every event is also dispatched to a
+    Session running that profile (Lua triggers, linebuffer).
+    """
+    master = HeadlessMaster()
+    replay = ReplayFile(filename, realtime)
+    t = telnet.Telnet(replay)
+
+    if profile is not None:
+        from mudblood import session
+        master.session = session.Session(master, profile)
+        master.session.bind(master.drain)
+        master.session.start()
+        # Like Session.replay
+        master.session.telnet = t
+        t.nativePrompts = master.session.nativePrompt
+        t.bind(master.session)
+    else:
+        t.bind(master.drain)
+
+    nbytes = 0
+    nevents = 0
+    start = clock()
+
+    t.running = True
+    while t.running:
+        t.poll()
+        while True:
+            ev = master.drain.get(False)
+            if ev is None:
+                break
+            nevents += 1
+            if isinstance(ev, event.RawEvent):
+                nbytes += len(ev.data)
+            if master.session is not None and not isinstance(ev, event.LogEvent):
+                master.session.event(ev)
+        if master.session is not None:
+            master.session.flush()
+
+    elapsed = clock() - start
+
+    ret = {"seconds": elapsed, "bytes": nbytes, "events": nevents,
+           "bytesPerSecond": nbytes / elapsed if elapsed > 0 else 0.0,
+           "eventsPerSecond": nevents / elapsed if elapsed > 0 else 0.0}
+
+    if master.session is not None:
+        lb = master.session.linebuffers.get('main')
+        ret["lines"] = len(lb.lines) if lb is not None else 0
+        master.session.destroy()
+
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a mudblood recording and measure throughput")
+    parser.add_argument("recording", help="The recording to replay")
+    parser.add_argument("--realtime", action='store_true',
+            help="Replay with the recorded timing instead of as fast as possible")
+    parser.add_argument("--profile", metavar="profile", default=None,
+            help="Dispatch events to a session running this profile")
+    options = parser.parse_args()
+
+    result = benchmark(options.recording, options.realtime, options.profile)
+    for k in sorted(result.keys()):
+        print("{:16} {}".format(k, result[k]))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 from mudblood import event
+import time
 import threading
 import Queue
 
 from mudblood import event
+from mudblood.timers import clock
 
 class ScreenEvent(object):
     pass
@@ -34,7 +36,81 @@ class KeystringScreenEvent(ScreenEvent):
 class DestroyScreenEvent(ScreenEvent):
     pass
 
+class FrameScheduler(object):
+    """
+    Paces redraws. While a frame is pending, further update requests are
+    collapsed into it, and frames are at least 1/maxFps seconds apart
+    (maxFps 0: no limit). While the main buffer grows by more than
+    degradeRate lines per second, frames are degraded: screens may reuse
+    the last rendering of side windows instead of rendering them again.
+    """
+    def __init__(self, maxFps=30, degradeRate=100):
+        self.maxFps = maxFps
+        self.degradeRate = degradeRate
+
+        self.lock = threading.Lock()
+        self.pending = False
+        self.lastFrame = 0.0
+        self.lastLines = 0
+
+        self.rendered = 0
+        self.dropped = 0
+        self.degraded = 0
+
+    def request(self):
+        """
+        Request a frame. Return True if a new frame has to be scheduled or
+        False if the request was collapsed into a pending frame.
+        """
+        with self.lock:
+            if self.pending:
+                self.dropped += 1
+                return False
+            self.pending = True
+            return True
+
+    def delay(self, now=None):
+        """
+        Return the number of seconds to wait before the next frame.
+        """
+        if not self.maxFps:
+            return 0.0
+        if now is None:
+            now = clock()
+        return max(0.0, self.lastFrame + 1.0 / self.maxFps - now)
+
+    def begin(self, lines, now=None):
+        """
+        Start drawing a frame. lines is the current length of the main
+        buffer. Requests from now on schedule a new frame.
+        Return True if the frame is degraded.
+        """
+        if now is None:
+            now = clock()
+
+        with self.lock:
+            self.pending = False
+
+        elapsed = now - self.lastFrame
+        rate = (lines - self.lastLines) / elapsed if elapsed > 0 else 0.0
+        self.lastFrame = now
+        self.lastLines = lines
+        self.rendered += 1
+
+        if self.degradeRate and rate > self.degradeRate:
+            self.degraded += 1
+            return True
+        return False
+
+    def stats(self):
+        return {"rendered": self.rendered, "dropped": self.dropped,
+                "degraded": self.degraded, "maxFps": self.maxFps}
+
 class Screen(event.Source):
+    # Screens that implement screenEvent() and drawFrame() can run on the
+    # master's thread (see inline)
+    supportsInline = False
+
     def __init__(self, master):
         super(Screen, self).__init__()
 
@@ -42,14 +118,73 @@ class Screen(event.Source):
         self.queue = Queue.Queue()
         self.master = master
         self.scroll_states = {}
+        self.frames = FrameScheduler()
+
+        # In inline mode, there is no screen thread. The master handles
+        # screen events with runPending(), draws with drawFrame() and polls
+        # the input source in its reactor.
+        self.inline = self.supportsInline and getattr(master, "singleThreaded", False)
 
     def start(self):
-        self.thread.start()
+        if not self.inline:
+            self.thread.start()
+
+    def startSource(self, source):
+        """
+        Start polling an input source, in its own thread or in the master's
+        reactor.
+        """
+        source.bind(self.master.drain)
+        if self.inline:
+            self.master.reactor.add(source)
+        else:
+            source.start()
+
+    def stopSource(self, source):
+        if self.inline:
+            self.master.reactor.remove(source)
+        else:
+            source.stop()
 
     def log(self, text):
         print(text)
 
     def run(self):
+        while True:
+            ev = self.nextEvent()
+            if ev is None:
+                continue
+
+            running = self.screenEvent(ev)
+            self.doneEvent()
+            if not running:
+                break
+
+    def runPending(self):
+        """
+        Handle all queued screen events without blocking. Used in inline
+        mode instead of the screen thread.
+        """
+        while True:
+            try:
+                ev = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            self.screenEvent(ev)
+            self.doneEvent()
+
+    def screenEvent(self, ev):
+        """
+        To be defined by screens that use the default run(). Handle one
+        screen event and return False after a DestroyScreenEvent.
+        """
+        return not isinstance(ev, DestroyScreenEvent)
+
+    def drawFrame(self):
+        """
+        Draw one frame. To be defined by screens that support inline mode.
+        """
         pass
 
     def tick(self):
@@ -69,9 +204,34 @@ class Screen(event.Source):
 
     def destroy(self):
         self.queue.put(DestroyScreenEvent())
+        if self.inline:
+            self.runPending()
 
     def updateScreen(self):
-        self.queue.put(UpdateScreenEvent())
+        # In inline mode, the master draws pending frames itself
+        if self.frames.request() and not self.inline:
+            self.queue.put(UpdateScreenEvent())
+
+    def beginFrame(self):
+        """
+        Called by the screen before drawing. Wait until the frame
+        scheduler allows the next frame. Return True if the frame is
+        degraded.
+        """
+        delay = self.frames.delay()
+        if delay > 0:
+            time.sleep(delay)
+
+        lines = 0
+        if self.master.session is not None and 'main' in self.master.session.linebuffers:
+            lines = len(self.master.session.linebuffers['main'].lines)
+        return self.frames.begin(lines)
+
+    def sessionChanged(self):
+        """
+        Called when another session becomes the active one.
+        """
+        self.scroll_states = {}
 
     def updateSize(self, w, h):
         self.queue.put(SizeScreenEvent(w, h))
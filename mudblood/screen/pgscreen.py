@@ -14,6 +14,7 @@ from mudblood import modes
 from mudblood import lua
 from mudblood import colors
 from mudblood import package
+from mudblood import trace
 from mudblood.screen import modalscreen
 
 keymap = {
@@ -390,6 +391,7 @@ class PygameScreen(modalscreen.ModalScreen):
                     self.modeManager.key(k)
 
             self.doUpdate()
+            trace.presented()
 
     def doUpdate(self):
         background = self.colormap_bg[colors.DEFAULT]
@@ -9,7 +9,9 @@ from mudblood import colors
 from mudblood import map
 from mudblood import window
 from mudblood import lua
+from mudblood import trace
 
+import sys
 import traceback
 import subprocess
 import tempfile
@@ -21,12 +23,35 @@ def createScreen(master):
     return TermboxScreen(master)
 
 class TermboxSource(event.AsyncSource):
-    def __init__(self, tb):
+    """
+    Reads input events from termbox. In its own thread, poll() waits for
+    the next event. When polled by a reactor (nonblocking), poll() returns
+    all events that are ready: All but the last are put directly.
+    """
+    def __init__(self, tb, nonblocking=False):
         self.tb = tb
+        self.nonblocking = nonblocking
         super(TermboxSource, self).__init__()
 
+    def fileno(self):
+        # The termbox binding does not expose its descriptor, but it reads
+        # from the terminal on stdin.
+        return sys.stdin.fileno()
+
     def poll(self):
-        ret = self.tb.peek_event(1000)
+        if not self.nonblocking:
+            return self.convert(self.tb.peek_event(1000))
+
+        last = None
+        while True:
+            ev = self.convert(self.tb.peek_event(0))
+            if ev is None:
+                return last
+            if last is not None:
+                self.put(last)
+            last = ev
+
+    def convert(self, ret):
         if ret == None:
             return None
 
@@ -83,7 +108,18 @@ class Lua_Screen(lua.LuaExposedObject):
     def scroll(self, value, name='main'):
         self._screen.moveScroll(name, value)
 
+    def fps(self, value=None):
+        if value is None:
+            return self._screen.frames.maxFps
+        else:
+            self._screen.frames.maxFps = value
+
+    def frameStats(self):
+        return self._lua.lua.table(**self._screen.frames.stats())
+
 class TermboxScreen(modalscreen.ModalScreen):
+    supportsInline = True
+
     def __init__(self, master):
         super(TermboxScreen, self).__init__(master)
 
@@ -100,46 +136,51 @@ class TermboxScreen(modalscreen.ModalScreen):
         self.logbuffer = linebuffer.Linebuffer()
 
         # Create a source for user input
-        self.source = TermboxSource(self.tb)
-        self.source.start()
-        self.source.bind(self.master.drain)
+        self.source = TermboxSource(self.tb, self.inline)
+        self.startSource(self.source)
 
         self.map_visible = False
         self.windows = []
         self.window_sizes = {}
+        # Last rendering of each side window for degraded frames
+        self.window_cache = {}
 
     def getLuaScreen(self, lua):
         return Lua_Screen(lua, self)
 
-    def run(self):
-        while True:
-            ev = self.nextEvent()
+    def sessionChanged(self):
+        super(TermboxScreen, self).sessionChanged()
+        self.window_cache = {}
 
-            if ev is None:
-                continue
-
-            if isinstance(ev, screen.UpdateScreenEvent):
-                self.doUpdate()
-            elif isinstance(ev, screen.SizeScreenEvent):
-                self.width, self.height = ev.w, ev.h
-            elif isinstance(ev, screen.DestroyScreenEvent):
-                self.tb.close()
-                self.doneEvent()
-                break
-            elif isinstance(ev, screen.ModeScreenEvent):
-                try:
-                    self.modeManager.setMode(ev.mode, **ev.args)
-                except modes.UnsupportedModeException:
-                    self.put(event.LogEvent("Unsupported mode: {}".format(ev.mode), "err"))
-            elif isinstance(ev, screen.KeyScreenEvent):
-                self.modeManager.key(ev.key)
-
-            self.doneEvent()
+    def screenEvent(self, ev):
+        if isinstance(ev, screen.UpdateScreenEvent):
+            self.drawFrame()
+        elif isinstance(ev, screen.SizeScreenEvent):
+            self.width, self.height = ev.w, ev.h
+        elif isinstance(ev, screen.DestroyScreenEvent):
+            self.tb.close()
+            return False
+        elif isinstance(ev, screen.ModeScreenEvent):
+            try:
+                self.modeManager.setMode(ev.mode, **ev.args)
+            except modes.UnsupportedModeException:
+                self.put(event.LogEvent("Unsupported mode: {}".format(ev.mode), "err"))
+        elif isinstance(ev, screen.KeyScreenEvent):
+            self.modeManager.key(ev.key)
+        return True
+
+    def drawFrame(self):
+        self.doUpdate(self.beginFrame())
+        trace.presented()
     
     def log(self, text):
         self.logbuffer.echo(text)
 
-    def doUpdate(self):
+    def doUpdate(self, degraded=False):
+        """
+        Draw the screen. In a degraded frame, side windows show their last
+        rendering if they have one.
+        """
         mainlb = self.master.session.linebuffers['main']
 
         self.tb.clear()
@@ -174,7 +215,7 @@ class TermboxScreen(modalscreen.ModalScreen):
                 if c[1] == "\t":
                     x += 8 - (x % 8)
                 else:
-                    if not (ord(c[1]) >= ord(" ") and ord(c[1]) <= ord("~")):
+                    if ord(c[1]) < ord(" ") or 0x7f <= ord(c[1]) < 0xa0:
                         continue
                         #self.tb.close()
                         #raise Exception("Non printable char {}. Line is: '{}'".format(ord(c[1]), [ord(x[1]) for x in l]))
@@ -267,15 +308,26 @@ class TermboxScreen(modalscreen.ModalScreen):
             x = 0
 
             wh = self.window_sizes[w]
+            cached = self.window_cache.get(w) if degraded else None
+            if cached is not None and cached[0] != (self.width, wh):
+                cached = None
+
             if w == 'map':
-                # TODO: Race condition! Map must be rendered in session thread!
-                m = map.AsciiMapRenderer(self.master.session.map).render(self.width, wh)
+                if cached is not None:
+                    m = cached[1]
+                else:
+                    # TODO: Race condition with the session thread, unless
+                    # the screen runs inline (--single)
+                    m = map.AsciiMapRenderer(self.master.session.map).render(self.width, wh)
+                    self.window_cache[w] = ((self.width, wh), m)
                 for i in range(self.width * wh):
                     self.tb.change_cell(x, y, m[i], colors.DEFAULT, colors.DEFAULT)
                     x += 1
                     if x == self.width:
                         x = 0
                         y += 1
+            elif cached is not None:
+                lines = cached[1]
             else:
                 lines = []
 
@@ -293,6 +345,9 @@ class TermboxScreen(modalscreen.ModalScreen):
                               + lb.render(self.width, 0, fixh)
                     else:
                         lines = lb.render(self.width, scroll, wh)
+                self.window_cache[w] = ((self.width, wh), lines)
+
+            if w != 'map':
                 if len(lines) < wh:
                     for i in range(wh - len(lines)):
                         x = 0
@@ -307,7 +362,7 @@ class TermboxScreen(modalscreen.ModalScreen):
                         if c[1] == "\t":
                             x += 8 - (x % 8)
                         else:
-                            if not (ord(c[1]) >= ord(" ") and ord(c[1]) <= ord("~")):
+                            if ord(c[1]) < ord(" ") or 0x7f <= ord(c[1]) < 0xa0:
                                 continue
                                 #self.tb.close()
                                 #raise Exception("Non printable char {}. Line is: '{}'".format(ord(c[1]), [ord(x[1]) for x in l]))
@@ -363,15 +418,14 @@ class TermboxScreen(modalscreen.ModalScreen):
             tmp.write(content.encode('utf8'))
             tmp.flush()
 
-            self.source.stop()
+            self.stopSource(self.source)
             self.tb.close()
 
             subprocess.call(["vim", tmp.name])
 
             self.tb = termbox.Termbox()
-            self.source = TermboxSource(self.tb)
-            self.source.start()
-            self.source.bind(self.master.drain)
+            self.source = TermboxSource(self.tb, self.inline)
+            self.startSource(self.source)
             self.tb.set_clear_attributes(termbox.DEFAULT, termbox.DEFAULT)
             self.tb.set_cursor(-1, -1)
 
@@ -389,15 +443,14 @@ class EditorMode(modes.Mode):
             tf.write(content)
             tname = tf.name
 
-        self.screen.source.stop()
+        self.screen.stopSource(self.screen.source)
         self.screen.tb.close()
 
         subprocess.call(["/usr/bin/gvim", "--nofork", tname])
 
         self.screen.tb = termbox.Termbox()
-        self.screen.source = TermboxSource(self.screen.tb)
-        self.screen.source.start()
-        self.screen.source.bind(self.screen.master.drain)
+        self.screen.source = TermboxSource(self.screen.tb, self.screen.inline)
+        self.screen.startSource(self.screen.source)
         self.screen.tb.set_clear_attributes(termbox.DEFAULT, termbox.DEFAULT)
         self.screen.tb.set_cursor(-1, -1)
 
@@ -1,3 +1,4 @@
+import os
 import sys
 import tty
 import termios
@@ -18,8 +19,12 @@ class Terminal(object):
     def write(self, data):
         sys.stdout.write(data)
 
+    def fileno(self):
+        return sys.stdin.fileno()
+
     def read(self, count):
-        return sys.stdin.read(count)
+        # Unbuffered, so that select() on fileno() sees all pending input
+        return os.read(sys.stdin.fileno(), count)
 
     def flush(self):
         sys.stdout.flush()
@@ -7,6 +7,7 @@ from mudblood import keys
 from mudblood import modes
 from mudblood import ansi
 from mudblood import screen
+from mudblood import trace
 from mudblood.screen import modalscreen
 
 from mudblood.screen import term
@@ -20,6 +21,9 @@ class TtySource(event.AsyncSource):
         self.term = term
         self.prefix = ""
 
+    def fileno(self):
+        return self.term.fileno()
+
     def poll(self):
         c = self.term.read(1)
 
@@ -39,6 +43,8 @@ class TtySource(event.AsyncSource):
         return event.KeyEvent(ord(c))
 
 class TtyScreen(modalscreen.ModalScreen):
+    supportsInline = True
+
     def __init__(self, master):
         super(TtyScreen, self).__init__(master)
 
@@ -52,34 +58,30 @@ class TtyScreen(modalscreen.ModalScreen):
 
         # Create a source for user input
         self.source = TtySource(self.term)
-        self.source.start()
-        self.source.bind(self.master.drain)
-
-    def run(self):
-        while True:
-            ev = self.nextEvent()
-
-            if ev is None:
-                continue
-
-            if isinstance(ev, screen.UpdateScreenEvent):
-                self.doUpdate()
-            elif isinstance(ev, screen.SizeScreenEvent):
-                self.width, self.height = ev.w, ev.h
-            elif isinstance(ev, screen.DestroyScreenEvent):
-                self.term.exit_keypad()
-                self.term.reset()
-                self.doneEvent()
-                break
-            elif isinstance(ev, screen.ModeScreenEvent):
-                self.modeManager.setMode(ev.mode, **ev.args)
-            elif isinstance(ev, screen.KeyScreenEvent):
-                if ev.key == ord("#"):
-                    self.put(event.ModeEvent("lua"))
-                else:
-                    self.modeManager.key(ev.key)
-
-            self.doneEvent()
+        self.startSource(self.source)
+
+    def screenEvent(self, ev):
+        if isinstance(ev, screen.UpdateScreenEvent):
+            self.drawFrame()
+        elif isinstance(ev, screen.SizeScreenEvent):
+            self.width, self.height = ev.w, ev.h
+        elif isinstance(ev, screen.DestroyScreenEvent):
+            self.term.exit_keypad()
+            self.term.reset()
+            return False
+        elif isinstance(ev, screen.ModeScreenEvent):
+            self.modeManager.setMode(ev.mode, **ev.args)
+        elif isinstance(ev, screen.KeyScreenEvent):
+            if ev.key == ord("#"):
+                self.put(event.ModeEvent("lua"))
+            else:
+                self.modeManager.key(ev.key)
+        return True
+
+    def drawFrame(self):
+        self.beginFrame()
+        self.doUpdate()
+        trace.presented()
 
     def doUpdate(self):
         lines = self.master.session.windows[0].linebuffer.lines
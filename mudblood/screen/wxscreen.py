@@ -3,6 +3,7 @@ import wx.lib.newevent
 
 from mudblood import event
 from mudblood import screen
+from mudblood import trace
 from mudblood import keys
 from mudblood import modes
 from mudblood import ansi
@@ -133,3 +134,4 @@ class WxScreen(modalscreen.ModalScreen):
         #self.text.SendTextUpdatedEvent()
 
         self.nlines = len(lines)
+        trace.presented()
@@ -1,5 +1,7 @@
 import os
+import codecs
 import traceback
+from collections import deque
 
 from mudblood import lua
 from mudblood import event
@@ -11,12 +13,17 @@ from mudblood import telnet
 from mudblood import keys
 from mudblood import map
 from mudblood import package
+from mudblood import record
+from mudblood import trace
 
 class Session(event.Source):
     """
     A session is one single connection to a server. Every session has its own socket,
     linebuffer, map and lua-runtime.
     """
+    # Marks sources that are sessions (see SessionManager.sessionFor)
+    isSession = True
+
     def __init__(self, master, profile=None):
         super(Session, self).__init__()
         
@@ -29,20 +36,58 @@ class Session(event.Source):
         self.bindings = keys.Bindings()
         self.telnet = None
         self.lastLine = ""
-        self.lastBlock = ""
         self.promptLine = ""
+        # Parsed versions of lastLine and promptLine for the screen
+        self.lastLineCache = ansi.LineCache()
+        self.promptLineCache = ansi.LineCache()
+
+        # Lines since the last prompt, stripped and joined to one line for
+        # block triggers. Every line is appended once. With streamBlocks,
+        # block triggers are queried after every line and a match starts a
+        # new block.
+        self.block = colors.AString()
+        self.streamBlocks = False
         self.ansi = ansi.Ansi()
         self.userStatus = colors.AString("")
         self.encoding = "utf8"
+        # Incremental decoder for incoming data. It keeps multibyte
+        # sequences that are split across RawEvents.
+        self.decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
         self.map = map.Map()
         self.rpc = None
         self.profile = profile
 
         self.local_echo = True
+        self.mccp = True
+        self.nativePrompt = False
+
+        # If set, raw traffic of the next connection is recorded to this file
+        self.recordFile = None
+
+        # TIMING-MARK ping interval in seconds (None: off) and the recent
+        # client-side lag of LatencyEvents
+        self.latencyInterval = None
+        self.latencyMonitor = None
+        self.lags = deque(maxlen=256)
 
         self.width = 0
         self.height = 0
 
+        # Set when a deadline of one of the Lua timers has passed
+        self.timersDue = False
+
+        # Event handlers by event class. Plugins may register handlers for
+        # their own event types here.
+        self.dispatcher = event.Dispatcher()
+        self.dispatcher.register(event.RawEvent, self.rawEvent)
+        self.dispatcher.register(event.DisconnectEvent, self.disconnectEvent)
+        self.dispatcher.register(event.InputEvent, self.inputEvent)
+        self.dispatcher.register(event.LuaEvent, self.luaEvent)
+        self.dispatcher.register(telnet.TelnetEvent, self.telnetEvent)
+        self.dispatcher.register(telnet.GMCPEvent, self.gmcp)
+        self.dispatcher.register(telnet.LatencyEvent, self.latencyEvent)
+        self.dispatcher.register(event.GridResizeEvent, self.gridResizeEvent)
+
     def start(self):
         if self.profile:
             self.log("Loading {}".format(self.profile), "info")
@@ -62,98 +107,148 @@ class Session(event.Source):
         """
         This function handles incoming events (see event.py)
         """
-        if isinstance(ev, event.RawEvent):
-            text = None
-            if self.encoding != "":
-                try:
-                    text = ev.data.decode(self.encoding)
-                except UnicodeDecodeError as e:
-                    self.encoding = "utf8"
-                    self.put(LogEvent("Error decoding data. Switching to 'utf8'"))
-                    try:
-                        text = ev.data.decode(self.encoding)
-                    except UnicodeDecodeError as e:
-                        self.encoding = ""
-                        self.push(event.LogEvent("Still no luck. Giving up, sorry. Maybe try a different encoding?"))
-                        return
-
-            lines = text.split("\n")
-
-            for l in lines:
-                self.lastBlock += l.strip() + " "
-
-            firstLine = self.lastLine + lines[0]
-            if len(lines) > 1:
-                parsedLines = []
-                for line in [firstLine] + lines[1:-1]:
-                    parsedLines.append(self.ansi.parseToAString(line))
-                for parsedLine in parsedLines:
-                    ret = None
-                    try:
-                        ret = self.lua.triggerRecv(parsedLine)
-                    except Exception as e:
-                        self.log("Lua error in recv trigger: {}\n{}".format(str(e), traceback.format_exc()), "err")
+        trace.stamp(ev, "dispatch")
+        self.dispatcher.dispatch(ev)
 
-                self.lastLine = lines[-1]
+        if ev.continuation:
+            try:
+                ev.continuation()
+            except Exception as e:
+                self.log("Lua error: {}\n{}".format(str(e), traceback.format_exc()), "err")
+
+    def rawEvent(self, ev):
+        text = self.decoder.decode(ev.data)
+
+        lines = text.split("\n")
+
+        firstLine = self.lastLine + lines[0]
+        if len(lines) > 1:
+            parsedLines = []
+            for line in [firstLine] + lines[1:-1]:
+                parsedLines.append(self.ansi.parseToAString(line))
+
+            if self.streamBlocks:
+                # Block triggers run between the lines' recv triggers
+                for parsedLine in parsedLines:
+                    self.triggerRecv([parsedLine])
+                    self.appendBlock(parsedLine)
+                    if self.triggerBlock(self.block):
+                        self.block = colors.AString()
             else:
-                self.lastLine = firstLine
+                self.triggerRecv(parsedLines)
+                for parsedLine in parsedLines:
+                    self.appendBlock(parsedLine)
 
-        elif isinstance(ev, event.DisconnectEvent):
-            self.log("Connection closed.", "info")
-            self.luaHook("disconnect")
-            self.telnet = None
+            trace.stamp(ev, "trigger")
+            self.lastLine = lines[-1]
+        else:
+            self.lastLine = firstLine
 
-        elif isinstance(ev, event.InputEvent):
-            if ev.display:
-                self.echo(self.getPromptLine() + colors.AString(ev.text).fg(colors.YELLOW))
-            self.lastLine = ""
+        if ev.prompt:
+            self.prompt()
 
-            self.processInput(ev.text)
+    def disconnectEvent(self, ev):
+        if self.telnet is not None and self.telnet.compressedBytes > 0:
+            self.log("MCCP2: {} bytes received, {} bytes inflated (ratio {:.1f}, {} bytes saved)".format(
+                *self.telnet.compressionStats()), "info")
+        self.log("Connection closed.", "info")
+        self.luaHook("disconnect")
+        self.telnet = None
+        self.setLatencyInterval(self.latencyInterval)
+        self.decoder.reset()
 
-        elif isinstance(ev, event.LuaEvent):
-            self.luaEval(ev.code)
+    def inputEvent(self, ev):
+        if ev.display:
+            self.echo(self.getPromptLine() + colors.AString(ev.text).fg(colors.YELLOW))
+        self.lastLine = ""
 
-        elif isinstance(ev, telnet.TelnetEvent):
-            self.put(event.LogEvent("Received Telneg {}".format(ev)))
+        self.processInput(ev.text)
+
+    def luaEvent(self, ev):
+        self.luaEval(ev.code)
+
+    def telnetEvent(self, ev):
+        self.put(event.LogEvent("Received Telneg {}".format(ev)))
+
+        if ev.option == telnet.OPT_ECHO:
+            if ev.cmd == telnet.WILL:
+                self.local_echo = True
+            elif ev.cmd == telnet.WONT:
+                self.local_echo = False
+        elif ev.option == telnet.OPT_NAWS and ev.cmd == telnet.DO and self.telnet is not None:
+            self.telnet.sendIAC(telnet.WILL, telnet.OPT_NAWS)
+            self.telnet.sendNaws(self.width, self.height)
+        elif ev.option == telnet.OPT_MCCP2 and ev.cmd == telnet.WILL and self.telnet is not None:
+            if self.mccp:
+                self.telnet.sendIAC(telnet.DO, telnet.OPT_MCCP2)
+            else:
+                self.telnet.sendIAC(telnet.DONT, telnet.OPT_MCCP2)
 
-            if ev.option == telnet.OPT_ECHO:
-                if ev.cmd == telnet.WILL:
-                    self.local_echo = True
-                elif ev.cmd == telnet.WONT:
-                    self.local_echo = False
-            elif ev.option == telnet.OPT_NAWS and ev.cmd == telnet.DO and self.telnet is not None:
-                self.telnet.sendIAC(telnet.WILL, telnet.OPT_NAWS)
-                self.telnet.sendNaws(self.width, self.height)
+        self.luaHook("telneg", ev.cmd, ev.option, ev.data)
 
-            self.luaHook("telneg", ev.cmd, ev.option, ev.data)
+    def latencyEvent(self, ev):
+        self.lags.append(telnet.clock() - ev.time)
+        self.luaHook("latency", self.latency())
 
-        elif isinstance(ev, telnet.GMCPEvent):
-            self.luaHook("gmcp", ev.module, ev.data)
+    def gridResizeEvent(self, ev):
+        self.width = ev.w
+        self.height = ev.h
 
-        elif isinstance(ev, event.GridResizeEvent):
-            self.width = ev.w
-            self.height = ev.h
+        if self.telnet is not None:
+            self.telnet.sendNaws(ev.w, ev.h)
 
-            if self.telnet is not None:
-                self.telnet.sendNaws(ev.w, ev.h)
+    def gmcp(self, ev):
+        """
+        Route a GMCP message to the Lua handlers subscribed to its package
+        and to the generic gmcp hook.
+        """
+        handlers = self.lua.gmcpHandlers(ev.module)
+        generic = self.lua.hasHook("gmcp")
+        if not handlers and not generic:
+            return
 
-        elif isinstance(ev, rpc.RPCEvent):
-            try:
-                if ev.literal:
-                    self.lua.execute(ev.literal)
-                else:
-                    f = self.lua.lua.globals()
-                    for s in ev.func:
-                        f = getattr(f, s)
-                    f(*ev.args)
-            except Exception as e:
-                self.log("Lua error in RPC: {}\n{}".format(str(e), traceback.format_exc()), "err")
+        try:
+            data = ev.data
+        except ValueError as e:
+            self.log("Invalid GMCP data for {}: {}".format(ev.module, str(e)), "err")
+            return
 
-        if ev.continuation:
+        for h in handlers:
             try:
-                ev.continuation()
+                h(ev.module, data)
             except Exception as e:
-                self.log("Lua error: {}\n{}".format(str(e), traceback.format_exc()), "err")
+                self.log("Lua error in GMCP handler: {}\n{}".format(str(e), traceback.format_exc()), "err")
+
+        if generic:
+            self.luaHook("gmcp", ev.module, data)
+
+    def setLatencyInterval(self, interval):
+        """
+        Start, restart or stop (interval None) the TIMING-MARK latency
+        monitor of the current connection.
+        """
+        self.latencyInterval = interval
+
+        if self.latencyMonitor is not None:
+            self.latencyMonitor.stop()
+            self.latencyMonitor = None
+
+        if interval is not None and self.telnet is not None and self.telnet.running:
+            self.latencyMonitor = telnet.LatencyMonitor(self.telnet, interval)
+            self.latencyMonitor.start()
+
+    def latency(self):
+        """
+        Return a Lua table with the round trip time statistics (count, min,
+        avg, p99, last) and the average client-side lag in seconds.
+        """
+        stats = self.telnet.latencyStats() if self.telnet is not None else None
+        lag = sum(self.lags) / len(self.lags) if self.lags else 0.0
+        if stats is None:
+            return self.lua.lua.table(count=0, lag=lag)
+
+        count, mn, avg, p99, last = stats
+        return self.lua.lua.table(count=count, min=mn, avg=avg, p99=p99, last=last, lag=lag)
 
     def processInput(self, text):
         for l in text.split("\n"):
@@ -167,24 +262,101 @@ class Session(event.Source):
         if self.telnet:
             self.telnet.write((text + "\n").encode(self.encoding))
 
+    def timerDeadline(self):
+        """
+        Called by the master's TimerHeap when a deadline of this session's
+        timers has passed.
+        """
+        self.timersDue = True
+
+    def getName(self):
+        return self.profile or "default"
+
+    name = property(getName)
+
+    def flush(self):
+        """
+        Send all output queued during this main loop iteration.
+        """
+        if self.telnet:
+            try:
+                self.telnet.flush()
+            except EnvironmentError as e:
+                self.log("Could not send: {}".format(str(e)), "err")
+
     def getLastLine(self):
-        return ansi.Ansi().parseToAString(self.lastLine)
+        return self.lastLineCache.parse(self.lastLine)
     def getPromptLine(self):
-        if self.promptLine == "":
+        promptLine = self.promptLine
+        if promptLine == "":
             return self.getLastLine()
         else:
-            return ansi.Ansi().parseToAString(self.promptLine)
+            return self.promptLineCache.parse(promptLine)
 
     def markPrompt(self):
         self.promptLine = self.lastLine
         self.lastLine = ""
+        # The last line's cache already holds the new prompt line
+        self.promptLineCache, self.lastLineCache = self.lastLineCache, self.promptLineCache
 
+        if self.promptLine != "":
+            self.appendBlock(self.promptLineCache.parse(self.promptLine))
+        block = self.block
+        self.block = colors.AString()
+        self.triggerBlock(block)
+
+    def triggerRecv(self, lines):
+        """
+        Query the recv triggers with a list of lines in one go.
+        """
         try:
-            ret = self.lua.triggerBlock(ansi.Ansi().parseToAString(self.lastBlock))
+            errors = self.lua.triggerRecvLines(lines)
+        except Exception as e:
+            self.log("Lua error in recv trigger: {}\n{}".format(str(e), traceback.format_exc()), "err")
+            return
+
+        for e in errors:
+            self.log("Lua error in recv trigger: {}".format(e), "err")
+
+    def appendBlock(self, line):
+        """
+        Add a parsed line to the current block.
+        """
+        self.block += line.strip()
+        self.block += " "
+
+    def triggerBlock(self, block):
+        """
+        Query the block triggers with a joined block. Return True if a
+        trigger fired.
+        """
+        try:
+            return self.lua.triggerBlock(block) == True
         except Exception as e:
             self.log("Lua error in block trigger: {}\n{}".format(str(e), traceback.format_exc()), "err")
+            return False
 
-        self.lastBlock = ""
+    def prompt(self):
+        """
+        Called when the server marks the last line as a prompt with GA or
+        EOR. The 'prompt' hook is only called if somebody listens.
+        """
+        self.lua.markPrompt()
+        if self.lua.hasHook("prompt"):
+            self.luaHook("prompt", self.promptLine)
+
+    def setEncoding(self, encoding):
+        """
+        Change the encoding of the server. Raises LookupError if the
+        encoding is unknown.
+        """
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.encoding = encoding
+
+    def setNativePrompt(self, native):
+        self.nativePrompt = native
+        if self.telnet is not None:
+            self.telnet.nativePrompts = native
 
     def echo(self, string, lb='main'):
         if lb not in self.linebuffers:
@@ -216,11 +388,27 @@ class Session(event.Source):
 
     def setRPCSocket(self, sock):
         if self.rpc:
-            self.rpc.stop()
+            self.stopSource(self.rpc)
 
         self.rpc = sock
         self.rpc.bind(self)
-        self.rpc.start()
+        self.startSource(self.rpc)
+
+    def startSource(self, source):
+        """
+        Start an asynchronous source, either in the master's reactor or in
+        its own thread.
+        """
+        if self.master.reactor is not None:
+            self.master.reactor.add(source)
+        else:
+            source.start()
+
+    def stopSource(self, source):
+        if self.master.reactor is not None:
+            self.master.reactor.remove(source)
+        else:
+            source.stop()
 
     def log(self, msg, level="info"):
         self.echo("-- {}".format(msg))
@@ -239,18 +427,47 @@ class Session(event.Source):
 
         try:
             sock = telnet.TCPSocket()
+            if self.recordFile is not None:
+                sock = record.RecordingSocket(sock, record.Recorder(self.recordFile))
+                self.log("Recording to {}".format(self.recordFile), "info")
             self.telnet = telnet.Telnet(sock)
             self.telnet.bind(self)
             sock.connect(host, port)
-            self.telnet.start()
+            if self.master.reactor is None:
+                self.telnet.channel = self.master.drain.openChannel()
+            self.startSource(self.telnet)
         except Exception as e:
             self.telnet = None
             self.log("Could not connect: {}".format(str(e)))
             return
 
+        self.telnet.buffered = True
+        self.telnet.nativePrompts = self.nativePrompt
+        self.setLatencyInterval(self.latencyInterval)
         self.log("Connection established.", "info")
         self.luaHook("connect", host, port)
 
+    def replay(self, filename, realtime=False):
+        """
+        Feed a recording into the session as if it came from a server.
+        """
+        if self.telnet:
+            self.log("Already connected")
+            return
+
+        try:
+            self.telnet = telnet.Telnet(record.ReplayFile(filename, realtime))
+        except Exception as e:
+            self.log("Could not replay {}: {}".format(filename, str(e)))
+            return
+
+        self.telnet.nativePrompts = self.nativePrompt
+        self.telnet.bind(self)
+        self.telnet.channel = self.master.drain.openChannel()
+        self.telnet.start()
+
+        self.log("Replaying {}.".format(filename), "info")
+
     def status(self, string=None):
         if string is None:
             pass
@@ -258,3 +475,118 @@ class Session(event.Source):
             self.userStatus = ansi.Ansi().parseToAString(string)
         return str(self.userStatus)
 
+class SessionManager(object):
+    """
+    The sessions of one Mudblood process. Events are routed to the session
+    their source belongs to and everything else goes to the active session,
+    which is the one on the screen. Sessions without traffic or due timers
+    are not touched by the main loop, except for flush().
+
+    With workers set, every session runs in its own process and is
+    represented by a worker.RemoteSession.
+    """
+    def __init__(self, master):
+        self.master = master
+        self.sessions = []
+        self.active = None
+        self.workers = False
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions))
+
+    def open(self, profile=None):
+        """
+        Create and start a new session. The first session becomes the
+        active one.
+        """
+        if self.workers:
+            from mudblood import worker
+            s = worker.RemoteSession(self.master, profile)
+        else:
+            s = Session(self.master, profile)
+        s.bind(self.master.drain)
+        self.sessions.append(s)
+        if self.active is None:
+            self.active = s
+
+        s.start()
+
+        screen = self.master.screen
+        if getattr(screen, "width", None) is not None:
+            s.put(event.GridResizeEvent(screen.width, screen.height))
+        return s
+
+    def close(self, s):
+        """
+        Destroy a disconnected session. If it was the active one, the first
+        remaining session becomes active. The last session cannot be closed,
+        the screen always needs an active one.
+        """
+        if self.sessions == [s]:
+            raise Exception("Cannot close the last session.")
+        s.destroy()
+        self.sessions.remove(s)
+        if self.active is s:
+            self.switch(self.sessions[0])
+
+    def switch(self, s):
+        """
+        Make another session the active one.
+        """
+        if s is self.active:
+            return
+        self.active = s
+        self.master.screen.sessionChanged()
+        self.master.screen.updateScreen()
+
+    def sessionFor(self, ev):
+        """
+        Return the session an event belongs to. Sources bound to a session
+        (like its Telnet) belong to that session.
+        """
+        source = ev.source
+        while source is not None:
+            if getattr(source, "isSession", False):
+                return source
+            source = getattr(source, "drain", None)
+        return self.active
+
+    def event(self, ev):
+        """
+        Dispatch an event. Return True if it went to the active session.
+        """
+        if isinstance(ev, event.GridResizeEvent) and not getattr(ev.source, "isSession", False):
+            for s in self.sessions:
+                s.event(ev)
+            return True
+
+        s = self.sessionFor(ev)
+        if s is None:
+            return False
+        s.event(ev)
+        return s is self.active
+
+    def triggerTime(self):
+        """
+        Query the timers of all sessions with a passed deadline. Return True
+        if the active session was among them.
+        """
+        ret = False
+        for s in self.sessions:
+            if s.timersDue:
+                s.timersDue = False
+                s.lua.triggerTime()
+                if s is self.active:
+                    ret = True
+        return ret
+
+    def flush(self):
+        for s in self.sessions:
+            s.flush()
+
+    def destroy(self):
+        for s in self.sessions:
+            s.destroy()
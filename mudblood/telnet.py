@@ -1,7 +1,12 @@
 import socket
 import struct
 import json
+import zlib
+import threading
+from collections import deque
 from mudblood import event
+from mudblood import trace
+from mudblood.timers import clock
 
 IAC = 255
 
@@ -31,8 +36,12 @@ OPT_TTYPE = 24
 OPT_EOR = 25
 OPT_NAWS = 31
 OPT_LINEMODE = 34
+OPT_MCCP2 = 86
 
 class TelnetEvent(event.Event):
+    __slots__ = ("cmd", "option", "data")
+    lane = event.LANE_NETWORK
+
     def __init__(self, cmd, option=None, data=None):
         super(TelnetEvent, self).__init__()
         self.cmd = cmd
@@ -45,23 +54,52 @@ class TelnetEvent(event.Event):
     def __eq__(self, other):
         return (isinstance(other, TelnetEvent) and self.cmd == other.cmd and self.option == other.option and self.data == other.data)
 
+class LatencyEvent(event.Event):
+    """
+    A TIMING-MARK round trip was measured.
+    Emitted by: Telnet
+    """
+    __slots__ = ("rtt", "time")
+    lane = event.LANE_NETWORK
+
+    def __init__(self, rtt):
+        super(LatencyEvent, self).__init__()
+        self.rtt = rtt
+        # When the reply was parsed. The difference to the time this event
+        # is handled is the client-side processing lag.
+        self.time = clock()
+
 class GMCPEvent(event.Event):
+    """
+    A GMCP message. The JSON payload is only decoded when data is accessed
+    for the first time.
+    """
+    __slots__ = ("module", "payload", "_data")
+    lane = event.LANE_NETWORK
+
     def __init__(self, data=None, module=None, obj=None):
         super(GMCPEvent, self).__init__()
 
         self.module = None
-        self.data = None
+        self.payload = None
+        self._data = None
 
         if data is not None:
             self.module, _, d = data.partition(" ")
-            if d == "":
-                self.data = None
-            else:
-                self.data = json.loads(d)
+            if d != "":
+                self.payload = d
 
         if module is not None:
             self.module = module
-            self.data = obj
+            self._data = obj
+
+    def getData(self):
+        if self.payload is not None:
+            self._data = json.loads(self.payload)
+            self.payload = None
+        return self._data
+
+    data = property(getData)
 
     def dump(self):
         if self.module is None:
@@ -73,113 +111,419 @@ class GMCPEvent(event.Event):
             return "{} {}".format(self.module, json.dumps(self.data))
 
 class TCPSocket(object):
+    # Bounds for the adaptive read size
+    MIN_READ = 1024
+    MAX_READ = 65536
+
     def __init__(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # Reusable receive buffer for readInto()
+        self.buffer = bytearray(self.MAX_READ)
+        self.view = memoryview(self.buffer)
+        self.readSize = self.MIN_READ
     
     def connect(self, host, port):
         self.socket.connect((host, port))
 
+    def fileno(self):
+        return self.socket.fileno()
+
     def read(self, size):
         ret = self.socket.recv(size)
         if ret == b'':
             return None
         return ret
 
+    def readInto(self):
+        """
+        Receive into the reusable buffer. Return the number of bytes
+        received (the data is self.buffer[:n]) or None on EOF. The buffer
+        contents are only valid until the next call.
+
+        The read size doubles whenever a read fills it completely and
+        shrinks again when reads stay small.
+        """
+        n = self.socket.recv_into(self.view, self.readSize)
+        if n == 0:
+            return None
+
+        if n == self.readSize:
+            self.readSize = min(self.readSize * 2, self.MAX_READ)
+        elif n < self.readSize // 4:
+            self.readSize = max(self.readSize // 2, self.MIN_READ)
+
+        return n
+
     def write(self, string):
-        self.socket.send(string)
+        self.socket.sendall(string)
+
+# Bytes that never make it into a RawEvent. Everything except ESC, newline,
+# printable ASCII and bytes of multibyte characters (0x80 and above) is
+# dropped; decoding is up to the session. Backspace is not in this set because it has
+# to be handled explicitly.
+_DROPPED = bytes(bytearray([c for c in range(256)
+                            if not (c == 0x1b or c == ord("\n") or c == ord("\b")
+                                    or (c >= ord(" ") and c <= ord("~")) or c >= 0x80)]))
 
 class Telnet(event.AsyncSource):
-    def __init__(self, file):
+    def __init__(self, file, fastParser=True):
         super(Telnet, self).__init__()
         self.file = file
 
+        # Use the chunk scanning parser (parseChunks) instead of the
+        # byte-by-byte state machine (parseBytes). Both emit the same events.
+        self.fastParser = fastParser
+
+        # Handle GA and EOR in the parser: Instead of a TelnetEvent, the
+        # text before them is emitted as a RawEvent with prompt set.
+        self.nativePrompts = False
+
         self.telnet_parsed = bytearray()
         self.telnet_state = 0
         self.telnet_command = 0
         self.telnet_option = 0
         self.telnet_data = bytearray()
 
+        # MCCP2 state. While decompressor is set, everything we read is
+        # inflated before it reaches the parser.
+        self.decompressor = None
+        self.compressedBytes = 0
+        self.decompressedBytes = 0
+
+        # Outbound queue. If buffered is set, writes are collected until
+        # flush() is called and then sent in one go.
+        self.buffered = False
+        self.outQueue = []
+        self.outSince = None
+        self.writeStats = {"writes": 0, "flushes": 0, "bytes": 0,
+                           "lastLatency": 0.0, "maxLatency": 0.0}
+
+        # Send times of unanswered TIMING-MARK pings and the last measured
+        # round trip times
+        self.pings = deque()
+        self.rtts = deque(maxlen=256)
+
+        # If set, events emitted by the source's own thread go through this
+        # Channel instead of the drain's lock. Set before start().
+        self.channel = None
+
+    def fileno(self):
+        return self.file.fileno()
+
     def poll(self):
-        ret = self.file.read(1024)
-        if ret == None:
-            self.running = False
-            self.put(event.DisconnectEvent())
+        if hasattr(self.file, "readInto"):
+            n = self.file.readInto()
+            if n is not None:
+                self.parse(self.file.buffer, n)
+                return
         else:
-            #parsed = bytearray()
-            #state = 0
-            #command = 0
-            #option = 0
-            #data = bytearray()
-
-            for d in ret:
-                # Remove in Python 3
-                c = ord(d)
-
-                if self.telnet_state == 1:
-                    if c >= 240:
-                        self.telnet_command = c
-                        self.telnet_state = 2
-                    else:
-                        self.telnet_command = c
-                        self.put(TelnetEvent(self.telnet_command, None, None))
-                        self.telnet_state = 0
-                elif self.telnet_state == 2:
-                    self.telnet_option = c
-                    if self.telnet_command == SB:
-                        self.telnet_state = 3
-                    else:
-                        self.put(TelnetEvent(self.telnet_command, self.telnet_option, None))
-                        self.telnet_state = 0
-                elif self.telnet_state == 3:
-                    if c == IAC:
-                        self.telnet_state = 4
-                    else:
-                        self.telnet_data.append(c)
-                elif self.telnet_state == 4:
-                    if c == SE:
-                        if self.telnet_option == 201:
-                            self.put(TelnetEvent(self.telnet_command, self.telnet_option, self.telnet_data))
-                            self.put(GMCPEvent(data=self.telnet_data.decode('utf8', errors='replace')))
-                        else:
-                            self.put(TelnetEvent(self.telnet_command, self.telnet_option, self.telnet_data))
-                        self.telnet_state = 0
-                    else:
-                        self.telnet_data.append(IAC)
-                        self.telnet_data.append(c)
-                elif c == IAC:
-                    if len(self.telnet_parsed) > 0:
-                        self.put(event.RawEvent(bytes(self.telnet_parsed)))
-
-                    self.telnet_parsed = bytearray()
-                    self.telnet_command = 0
-                    self.telnet_option = 0
-                    self.telnet_data = bytearray()
-
-                    self.telnet_state = 1
-                elif c == ord("\r"):
-                    pass
-                elif c == ord("\b"):
+            ret = self.file.read(1024)
+            if ret is not None:
+                self.parse(ret)
+                return
+
+        self.running = False
+        self.put(event.DisconnectEvent())
+        if self.channel is not None and threading.current_thread() is self.thread:
+            self.channel.close()
+
+    def put(self, ev):
+        # Only the source's thread may write to the channel. Events from
+        # other threads (e.g. logging in write()) take the normal path.
+        if self.channel is None or threading.current_thread() is not self.thread:
+            super(Telnet, self).put(ev)
+            return
+
+        if not ev.source:
+            ev.source = self
+        if trace.tracer is not None:
+            trace.tracer.put(ev)
+        self.channel.put(ev)
+
+    def parse(self, data, end=None):
+        """
+        Feed a chunk of received bytes into the parser and emit the resulting
+        events. Plain text is flushed as a RawEvent at the end of the chunk.
+
+        If data is a bytearray, only data[:end] is parsed and nothing is
+        copied, so the caller may reuse the buffer afterwards.
+        """
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        if end is None:
+            end = len(data)
+
+        if self.decompressor is not None:
+            data = self.decompress(memoryview(data)[:end])
+            end = len(data)
+
+        while end > 0:
+            if self.fastParser:
+                pos = self.parseChunks(data, end)
+            else:
+                pos = self.parseBytes(data, end)
+
+            if pos is None:
+                break
+
+            # The server started compressing: The rest of the chunk is
+            # the beginning of the zlib stream.
+            data = self.decompress(memoryview(data)[pos:end])
+            end = len(data)
+
+        self.flushParsed()
+
+    def flushParsed(self, prompt=False):
+        """
+        Emit the text parsed so far as a RawEvent. A prompt is emitted even
+        if there is no new text, the prompt may have arrived earlier.
+        """
+        if prompt or len(self.telnet_parsed) > 0:
+            self.put(event.RawEvent(bytes(self.telnet_parsed), prompt))
+
+        self.telnet_parsed = bytearray()
+
+    def parseBytes(self, data, end):
+        """
+        Reference parser: Walk every byte through the state machine.
+        Return the position after the start of compression or None.
+        """
+        for i in range(end):
+            if self.parseByte(data[i]):
+                return i + 1
+        return None
+
+    def parseChunks(self, data, end):
+        """
+        Fast parser: Copy runs of plain text and subnegotiation data in one
+        step and only use the state machine around IAC sequences.
+        Return the position after the start of compression or None.
+        """
+        view = memoryview(data)
+        pos = 0
+
+        while pos < end:
+            if self.telnet_state == 0:
+                i = data.find(b'\xff', pos, end)
+                if i == -1:
+                    i = end
+                if i > pos:
+                    self.appendText(view[pos:i].tobytes())
+                pos = i
+                if pos < end:
+                    self.parseByte(IAC)
+                    pos += 1
+            elif self.telnet_state == 3:
+                i = data.find(b'\xff', pos, end)
+                if i == -1:
+                    i = end
+                self.telnet_data += view[pos:i]
+                pos = i
+                if pos < end:
+                    self.parseByte(IAC)
+                    pos += 1
+            else:
+                pos += 1
+                if self.parseByte(data[pos-1]):
+                    return pos
+        return None
+
+    def decompress(self, data):
+        """
+        Inflate MCCP2 compressed data (a memoryview). If the compressed
+        stream ends, the remaining bytes are passed through as they are.
+        """
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+            self.put(event.LogEvent("Telnet: MCCP2 compression started", "debug"))
+
+        try:
+            ret = bytearray(self.decompressor.decompress(data.tobytes()))
+        except zlib.error as e:
+            self.decompressor = None
+            self.put(event.LogEvent("Telnet: MCCP2 error: {}".format(e), "err"))
+            return bytearray()
+
+        rest = self.decompressor.unused_data
+        self.compressedBytes += len(data) - len(rest)
+        self.decompressedBytes += len(ret)
+
+        if rest or getattr(self.decompressor, "eof", False):
+            self.decompressor = None
+            self.put(event.LogEvent("Telnet: MCCP2 compression ended", "debug"))
+            ret += bytearray(rest)
+
+        return ret
+
+    def compressionStats(self):
+        """
+        Return a tuple (compressed bytes, decompressed bytes, ratio, bytes saved)
+        for all data received with MCCP2.
+        """
+        ratio = 1.0
+        if self.compressedBytes > 0:
+            ratio = float(self.decompressedBytes) / self.compressedBytes
+        return (self.compressedBytes, self.decompressedBytes, ratio,
+                self.decompressedBytes - self.compressedBytes)
+
+    def appendText(self, text):
+        """
+        Append a run of plain text (without IAC) to the parsed buffer.
+        """
+        text = text.translate(None, _DROPPED)
+        if len(self.telnet_parsed) == 0 and b'\b' not in text:
+            # Common case: Keep the translated bytes as they are. They
+            # become the RawEvent's data without another copy.
+            self.telnet_parsed = text
+            return
+
+        self.telnet_parsed = bytearray(self.telnet_parsed)
+        if b'\b' in text:
+            for c in bytearray(text):
+                if c == ord("\b"):
                     self.telnet_parsed = self.telnet_parsed[:-1]
-                elif c == 0x1b or c == ord("\n") or (c >= ord(" ") and c <= ord("~")):
+                else:
                     self.telnet_parsed.append(c)
+        else:
+            self.telnet_parsed += text
+
+    def parseByte(self, c):
+        """
+        Perform one step of the telnet state machine. Return True if the
+        server just started MCCP2 compression.
+        """
+        if self.telnet_state == 1:
+            if self.nativePrompts:
+                if c == GA or c == EOR:
+                    self.flushParsed(True)
+                    self.telnet_state = 0
+                    return False
+                self.flushParsed()
+
+            if c >= 240:
+                self.telnet_command = c
+                self.telnet_state = 2
+            else:
+                self.telnet_command = c
+                self.put(TelnetEvent(self.telnet_command, None, None))
+                self.telnet_state = 0
+        elif self.telnet_state == 2:
+            self.telnet_option = c
+            if self.telnet_command == SB:
+                self.telnet_state = 3
+            elif c == OPT_TIMING_MARK and self.pings and (self.telnet_command == WILL or self.telnet_command == WONT):
+                rtt = clock() - self.pings.popleft()
+                self.rtts.append(rtt)
+                self.put(LatencyEvent(rtt))
+                self.telnet_state = 0
+            else:
+                self.put(TelnetEvent(self.telnet_command, self.telnet_option, None))
+                self.telnet_state = 0
+        elif self.telnet_state == 3:
+            if c == IAC:
+                self.telnet_state = 4
+            else:
+                self.telnet_data.append(c)
+        elif self.telnet_state == 4:
+            if c == SE:
+                if self.telnet_option == 201:
+                    self.put(TelnetEvent(self.telnet_command, self.telnet_option, self.telnet_data))
+                    self.put(GMCPEvent(data=self.telnet_data.decode('utf8', errors='replace')))
+                else:
+                    self.put(TelnetEvent(self.telnet_command, self.telnet_option, self.telnet_data))
+                self.telnet_state = 0
+                if self.telnet_option == OPT_MCCP2:
+                    return True
+            else:
+                self.telnet_data.append(IAC)
+                self.telnet_data.append(c)
+        elif c == IAC:
+            # With native prompts, the text is kept until we know whether
+            # this is a GA or EOR
+            if not self.nativePrompts:
+                self.flushParsed()
+
+            self.telnet_command = 0
+            self.telnet_option = 0
+            self.telnet_data = bytearray()
+
+            self.telnet_state = 1
+        elif c == ord("\r"):
+            pass
+        elif c == ord("\b"):
+            self.telnet_parsed = self.telnet_parsed[:-1]
+        elif c == 0x1b or c == ord("\n") or (c >= ord(" ") and c <= ord("~")) or c >= 0x80:
+            self.telnet_parsed.append(c)
+
+    def write(self, buf):
+        self.writeStats["writes"] += 1
+        if self.buffered:
+            if not self.outQueue:
+                self.outSince = clock()
+            self.outQueue.append(bytes(buf))
+        else:
+            self.file.write(buf)
 
-            if len(self.telnet_parsed) > 0:
-                self.put(event.RawEvent(bytes(self.telnet_parsed)))
+    def flush(self):
+        """
+        Send everything that was queued since the last flush as a single
+        write.
+        """
+        if not self.outQueue:
+            return
 
-            self.telnet_parsed = bytearray()
+        queue, self.outQueue = self.outQueue, []
+        data = b"".join(queue)
 
-    def write(self, buf):
-        self.file.write(buf)
+        latency = clock() - self.outSince
+        self.writeStats["flushes"] += 1
+        self.writeStats["bytes"] += len(data)
+        self.writeStats["lastLatency"] = latency
+        self.writeStats["maxLatency"] = max(latency, self.writeStats["maxLatency"])
+
+        self.file.write(data)
+
+    def queueDepth(self):
+        """
+        Return the number of writes and bytes waiting for flush().
+        """
+        return len(self.outQueue), sum(len(b) for b in self.outQueue)
 
     def sendIAC(self, command, option):
         b = bytearray([IAC, command, option])
         self.put(event.LogEvent("Telnet: Sending {}".format(list(b)), "debug"))
-        self.file.write(b)
+        self.write(b)
 
     def sendSubneg(self, option, data):
         b = bytearray([IAC, SB, option]) + bytearray(data) + bytearray([IAC, SE])
         self.put(event.LogEvent("Telnet: Sending {}".format(list(b)), "debug"))
-        self.file.write(b)
+        self.write(b)
+
+    def ping(self):
+        """
+        Send a TIMING-MARK request. The server's reply is matched in the
+        parser and yields a LatencyEvent. Like every write, this must be
+        called from the thread that flushes the outbound queue.
+        """
+        # Forget pings the server never answered
+        while len(self.pings) >= 8:
+            self.pings.popleft()
+
+        self.pings.append(clock())
+        self.write(bytearray([IAC, DO, OPT_TIMING_MARK]))
+
+    def latencyStats(self):
+        """
+        Return a tuple (count, min, avg, p99, last) of the recent round trip
+        times in seconds or None if nothing was measured yet.
+        """
+        rtts = list(self.rtts)
+        if not rtts:
+            return None
+
+        s = sorted(rtts)
+        return (len(s), s[0], sum(s) / len(s), s[min(len(s) - 1, int(len(s) * 0.99))], rtts[-1])
 
     def sendGMCP(self, gmcp):
         self.sendSubneg(201, gmcp.dump().encode('utf8'))
@@ -187,3 +531,28 @@ class Telnet(event.AsyncSource):
     def sendNaws(self, w, h):
         self.sendSubneg(OPT_NAWS, struct.pack('!HH', w, h))
 
+
+class LatencyMonitor(object):
+    """
+    Pings a Telnet connection with TIMING-MARK requests in a fixed interval.
+    The pings are sent by the consumer of the connection's events, so they
+    do not interleave with its writes.
+    """
+    def __init__(self, telnet, interval=10.0):
+        self.telnet = telnet
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.telnet.running:
+                break
+            self.telnet.put(event.CallableEvent(self.telnet.ping))
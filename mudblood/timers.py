@@ -0,0 +1,126 @@
+# ----------------------------------------------------------------------------
+#
+# -- mudblood - a flexible mud client --
+#
+# timers.py
+#
+# A heap of deadlines on the monotonic clock. The main loop sleeps until the
+# next deadline (or the next event) and only queries the Lua timers when a
+# deadline has passed.
+#
+# ----------------------------------------------------------------------------
+
+import os
+import time
+import heapq
+import threading
+
+def monotonicClock():
+    """
+    Return a function that reads a monotonic clock in seconds. Python 2 has
+    no time.monotonic, so clock_gettime is called through ctypes there.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+
+    try:
+        import sys
+        import ctypes
+        import ctypes.util
+
+        # Older glibc versions have clock_gettime in librt
+        for name in ["c", "rt"]:
+            lib = ctypes.CDLL(ctypes.util.find_library(name), use_errno=True)
+            if hasattr(lib, "clock_gettime"):
+                break
+        clock_gettime = lib.clock_gettime
+
+        CLOCK_MONOTONIC = 6 if sys.platform == "darwin" else 1
+
+        # A struct timespec per thread, allocated once. Allocating it for
+        # every call makes the clock several times slower.
+        local = threading.local()
+
+        def monotonic():
+            try:
+                t = local.timespec
+            except AttributeError:
+                t = local.timespec = (ctypes.c_long * 2)()
+            if clock_gettime(CLOCK_MONOTONIC, t) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t[0] + t[1] * 1e-9
+
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError):
+        # Not monotonic: wall clock jumps (NTP, suspend) fire deadlines
+        # early or late
+        return time.time
+
+# The clock of all deadlines and latency measurements. Use this one instead
+# of time.time().
+clock = monotonicClock()
+
+class TimerHeap(object):
+    """
+    Deadlines (in clock() seconds) with optional callbacks, ordered by time.
+    Deadlines are meant to be added from the thread that sleeps on the heap;
+    a deadline added from another thread does not interrupt a sleep that is
+    already in progress.
+    """
+    def __init__(self):
+        self.heap = []
+        self.lock = threading.Lock()
+        # Tie breaker, so that callbacks are never compared
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, deadline, callback=None):
+        """
+        Add a deadline. When it has passed, expire() calls callback().
+        """
+        with self.lock:
+            heapq.heappush(self.heap, (deadline, self.counter, callback))
+            self.counter += 1
+
+    def addDelay(self, delay, callback=None):
+        """
+        Add a deadline delay seconds from now.
+        """
+        self.add(clock() + delay, callback)
+
+    def timeout(self, now=None):
+        """
+        Return the number of seconds until the next deadline (0 if it has
+        already passed) or None if there is no deadline.
+        """
+        with self.lock:
+            if not self.heap:
+                return None
+            deadline = self.heap[0][0]
+
+        if now is None:
+            now = clock()
+        return max(0.0, deadline - now)
+
+    def expire(self, now=None):
+        """
+        Remove all deadlines that have passed and call their callbacks.
+        Return the number of removed deadlines.
+        """
+        if now is None:
+            now = clock()
+
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+
+        for deadline, n, callback in due:
+            if callback is not None:
+                callback()
+
+        return len(due)
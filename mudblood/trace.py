@@ -0,0 +1,181 @@
+# ----------------------------------------------------------------------------
+#
+# -- mudblood - a flexible mud client --
+#
+# trace.py
+#
+# Optional instrumentation of the event pipeline. While tracing is enabled,
+# every event is stamped when a source emits it and again at each stage it
+# passes:
+#
+#   queue    - Taken from the Drain (time spent in the queue)
+#   dispatch - Handed to Mudblood.event or Session.event
+#   trigger  - Lua recv triggers are done with it (RawEvents only)
+#   present  - The screen has drawn the result
+#   total    - From emission to presentation
+#
+# The time since the previous stamp is aggregated into one histogram per
+# event type and stage.
+#
+# ----------------------------------------------------------------------------
+
+import threading
+
+from mudblood.timers import clock
+
+STAGES = ["queue", "dispatch", "trigger", "present", "total"]
+
+class Histogram(object):
+    """
+    A log-linear histogram of durations in the style of HdrHistogram. Values
+    are recorded in microseconds. Up to 64 they are exact, above that every
+    power of two is split into 32 buckets, which keeps the relative error
+    below about 3% with a small, fixed number of buckets.
+    """
+    SUB_BITS = 6
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, seconds):
+        v = max(0, int(seconds * 1000000))
+
+        shift = max(0, v.bit_length() - self.SUB_BITS)
+        key = (shift << self.SUB_BITS) | (v >> shift)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+
+    def bucketValue(self, key):
+        """
+        Return the upper bound of the values in a bucket.
+        """
+        shift = key >> self.SUB_BITS
+        mantissa = key & ((1 << self.SUB_BITS) - 1)
+        return ((mantissa + 1) << shift) - 1
+
+    def percentile(self, p):
+        """
+        Return the value (in microseconds) below which p percent of the
+        recorded values lie.
+        """
+        if self.count == 0:
+            return 0
+
+        limit = self.count * p / 100.0
+        n = 0
+        for key in sorted(self.buckets.keys()):
+            n += self.buckets[key]
+            if n >= limit:
+                return min(self.bucketValue(key), self.max)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return float(self.total) / self.count
+
+class Tracer(object):
+    """
+    Collects stage stamps of events into histograms. Stamps are stored in
+    the event's trace attribute as [emitted, last stamp, last stage].
+    """
+    # Events waiting for presentation are dropped beyond this number, e.g.
+    # when there is no screen
+    MAX_PENDING = 10000
+
+    def __init__(self):
+        self.histograms = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.started = clock()
+
+    def put(self, ev):
+        if ev.trace is None:
+            now = clock()
+            ev.trace = [now, now, "put"]
+
+    def stamp(self, ev, stage):
+        t = getattr(ev, "trace", None)
+        if t is None or t[2] == stage:
+            return
+
+        now = clock()
+        with self.lock:
+            self.record(type(ev).__name__, stage, now - t[1])
+            t[1] = now
+            t[2] = stage
+
+            if stage == "dispatch" and len(self.pending) < self.MAX_PENDING:
+                self.pending.append(ev)
+
+    def presented(self):
+        now = clock()
+        with self.lock:
+            pending, self.pending = self.pending, []
+            for ev in pending:
+                name = type(ev).__name__
+                self.record(name, "present", now - ev.trace[1])
+                self.record(name, "total", now - ev.trace[0])
+
+    def record(self, name, stage, seconds):
+        h = self.histograms.get((name, stage))
+        if h is None:
+            h = self.histograms[(name, stage)] = Histogram()
+        h.record(seconds)
+
+    def report(self):
+        """
+        Return the histograms as a text table. Times are in milliseconds.
+        """
+        lines = ["Trace of {:.1f} seconds".format(clock() - self.started),
+                 "{:16} {:8} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+                     "event", "stage", "count", "min", "mean", "p50", "p90", "p99", "max")]
+
+        with self.lock:
+            for name, stage in sorted(self.histograms.keys(), key=lambda k: (k[0], STAGES.index(k[1]))):
+                h = self.histograms[(name, stage)]
+                lines.append("{:16} {:8} {:8d} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.3f}".format(
+                    name, stage, h.count, h.min / 1000.0, h.mean() / 1000.0,
+                    h.percentile(50) / 1000.0, h.percentile(90) / 1000.0,
+                    h.percentile(99) / 1000.0, h.max / 1000.0))
+
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            f.write(self.report() + "\n")
+
+# The active tracer or None if tracing is disabled
+tracer = None
+
+def enable():
+    global tracer
+    if tracer is None:
+        tracer = Tracer()
+    return tracer
+
+def disable():
+    global tracer
+    tracer = None
+
+def stamp(ev, stage):
+    if tracer is not None:
+        tracer.stamp(ev, stage)
+
+def presented():
+    """
+    Called by screens after drawing. All events dispatched since the last
+    call count as presented.
+    """
+    if tracer is not None:
+        tracer.presented()
@@ -0,0 +1,396 @@
+# ----------------------------------------------------------------------------
+#
+# -- mudblood - a flexible mud client --
+#
+# worker.py
+#
+# Process-per-session mode. Every session (telnet connection, Lua runtime,
+# map) runs in a worker process, so slow triggers of one session do not
+# stall the others and sessions spread across cores. The UI process keeps a
+# RemoteSession per worker that mirrors what the screen needs:
+#
+#   worker -> UI: New linebuffer lines, prompt and last line, status line,
+#                 key bindings, log messages, mode and quit requests and
+#                 calls of the Lua screen object
+#   UI -> worker: Input, Lua commands, grid size and triggered bindings
+#
+# Messages are tuples sent over two one-way pipes. The worker batches
+# everything that changed in one loop iteration into a single message list.
+#
+# ----------------------------------------------------------------------------
+
+import threading
+import traceback
+import multiprocessing
+
+from mudblood import event
+from mudblood import record
+from mudblood import lua
+from mudblood import reactor
+from mudblood import linebuffer
+from mudblood import colors
+from mudblood import ansi
+from mudblood import keys
+from mudblood import map
+
+# Python 2 has no start methods. Elsewhere, a fresh interpreter avoids
+# inheriting the UI's threads and terminal state.
+if hasattr(multiprocessing, "get_context"):
+    context = multiprocessing.get_context("spawn")
+else:
+    context = multiprocessing
+
+class RemoteEvent(event.Event):
+    """
+    A list of messages received from the other side of a worker pipe.
+    Emitted by: ConnectionSource
+    """
+    __slots__ = ("messages",)
+    lane = event.LANE_NETWORK
+
+    def __init__(self, messages):
+        super(RemoteEvent, self).__init__()
+        self.messages = messages
+
+class ConnectionSource(event.AsyncSource):
+    """
+    Reads message lists from a multiprocessing connection. When the other
+    side goes away, it emits a last RemoteEvent with a 'closed' message.
+    """
+    def __init__(self, conn):
+        super(ConnectionSource, self).__init__()
+        self.conn = conn
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def poll(self):
+        try:
+            return RemoteEvent(self.conn.recv())
+        except (EOFError, IOError):
+            self.running = False
+            return RemoteEvent([("closed",)])
+
+class Publisher(object):
+    """
+    Collects the changes of a session since the last call of updates().
+    Linebuffers only grow, so only lines that were not sent yet are sent.
+    """
+    def __init__(self):
+        self.sent = {}
+        self.prompt = ("", "")
+        self.status = None
+        self.bindings = ()
+        self.messages = []
+
+    def send(self, message):
+        """
+        Queue a message for the next update.
+        """
+        self.messages.append(message)
+
+    def updates(self, session):
+        """
+        Return a list of messages with everything that changed.
+        """
+        ret, self.messages = self.messages, []
+
+        for name, lb in session.linebuffers.items():
+            n = self.sent.get(name, 0)
+            if len(lb.lines) > n:
+                ret.append(("lines", name, [l.string for l in lb.lines[n:]]))
+                self.sent[name] = len(lb.lines)
+
+        prompt = (session.promptLine, session.lastLine)
+        if prompt != self.prompt:
+            ret.append(("prompt",) + prompt)
+            self.prompt = prompt
+
+        if session.userStatus is not self.status:
+            ret.append(("status", session.userStatus.string))
+            self.status = session.userStatus
+
+        bindings = tuple(sorted(session.bindings.bindings.keys()))
+        if bindings != self.bindings:
+            ret.append(("bindings", bindings))
+            self.bindings = bindings
+
+        return ret
+
+class Lua_Screen(lua.Lua_HeadlessScreen):
+    """
+    The Lua screen object of a worker. Queries are answered from what the
+    worker knows, changes are forwarded to the screen of the UI process.
+    """
+    def _forward(self, name, *args):
+        self._screen.publisher.send(("screen", name, args))
+
+    def windowVisible(self, name, value=None):
+        if value is None:
+            return super(Lua_Screen, self).windowVisible(name)
+        super(Lua_Screen, self).windowVisible(name, value)
+        self._forward("windowVisible", name, value)
+
+    def windowSize(self, name, value=None):
+        if value is None:
+            return super(Lua_Screen, self).windowSize(name)
+        super(Lua_Screen, self).windowSize(name, value)
+        self._forward("windowSize", name, value)
+
+    def scroll(self, value, name='main'):
+        self._forward("scroll", value, name)
+
+    def fps(self, value=None):
+        if value is None:
+            return super(Lua_Screen, self).fps()
+        super(Lua_Screen, self).fps(value)
+        self._forward("fps", value)
+
+class WorkerScreen(record.HeadlessScreen):
+    """
+    Screen of a worker process. It keeps the grid size and the window
+    layout set from Lua.
+    """
+    def __init__(self, publisher, width=80, height=24):
+        super(WorkerScreen, self).__init__(width, height)
+        self.publisher = publisher
+
+    def getLuaScreen(self, lua):
+        return Lua_Screen(lua, self)
+
+    def log(self, text):
+        self.publisher.send(("log", text, "info"))
+
+class WorkerMaster(record.HeadlessMaster):
+    """
+    Runs one session in a worker process. Like Mudblood in single threaded
+    mode, it polls the session's sockets and the command pipe with a
+    reactor on the main thread.
+    """
+    def __init__(self, commands, output, size=(80, 24)):
+        super(WorkerMaster, self).__init__()
+        self.publisher = Publisher()
+        self.screen = WorkerScreen(self.publisher, *size)
+        self.output = output
+        self.running = False
+
+        self.reactor = reactor.Reactor()
+        self.drain.waker = self.reactor.wake
+        self.drain.consumer = threading.current_thread()
+
+        self.commands = ConnectionSource(commands)
+        self.commands.bind(self.drain)
+
+        self.dispatcher = event.Dispatcher()
+        self.dispatcher.register(RemoteEvent, self.remoteEvent)
+        self.dispatcher.register(event.LogEvent, lambda ev: self.publisher.send(("log", ev.msg, ev.level)))
+        self.dispatcher.register(event.QuitEvent, lambda ev: self.publisher.send(("quit",)))
+        self.dispatcher.register(event.ModeEvent, self.modeEvent)
+        self.dispatcher.register(event.CallableEvent, self.callableEvent)
+
+    def run(self, profile):
+        from mudblood import session
+
+        self.session = session.Session(self, profile)
+        self.session.bind(self.drain)
+        self.session.start()
+
+        self.running = True
+        self.reactor.add(self.commands)
+
+        while self.running:
+            timeout = self.timers.timeout()
+            self.drain.sleeping = True
+            if not self.drain.empty():
+                timeout = 0
+            try:
+                self.reactor.runOnce(timeout)
+            finally:
+                self.drain.sleeping = False
+
+            for ev in self.drain.drainAll():
+                if not self.dispatcher.dispatch(ev):
+                    self.session.event(ev)
+
+            if self.timers.expire() > 0 and self.session.timersDue:
+                self.session.timersDue = False
+                self.session.lua.triggerTime()
+            self.session.flush()
+
+            updates = self.publisher.updates(self.session)
+            if updates:
+                self.output.send(updates)
+
+        self.session.destroy()
+
+    def remoteEvent(self, ev):
+        for msg in ev.messages:
+            if msg[0] == "input":
+                self.session.event(event.InputEvent(msg[1], msg[2]))
+            elif msg[0] == "lua":
+                self.session.event(event.LuaEvent(msg[1]))
+            elif msg[0] == "resize":
+                self.screen.width, self.screen.height = msg[1], msg[2]
+                self.session.event(event.GridResizeEvent(msg[1], msg[2]))
+            elif msg[0] == "binding":
+                self.binding(msg[1])
+            elif msg[0] in ("quit", "closed"):
+                self.running = False
+
+    def binding(self, keys):
+        value = self.session.bindings.getBinding(keys)
+        if callable(value):
+            self.callableEvent(event.CallableEvent(value))
+        elif value is not None:
+            self.session.event(event.InputEvent(value))
+
+    def modeEvent(self, ev):
+        # Arguments may contain Lua objects, which stay in this process
+        if ev.args:
+            self.publisher.send(("log", "Mode {} is not available in worker sessions".format(ev.mode), "err"))
+        else:
+            self.publisher.send(("mode", ev.mode))
+
+    def callableEvent(self, ev):
+        try:
+            ev.call(*ev.args)
+        except Exception as e:
+            self.publisher.send(("log", "{}\n{}".format(str(e), traceback.format_exc()), "err"))
+
+def runWorker(profile, commands, output, size):
+    """
+    Entry point of a worker process.
+    """
+    WorkerMaster(commands, output, size).run(profile)
+
+class RemoteSession(event.Source):
+    """
+    UI side of a session that runs in a worker process. It has the
+    attributes the screens read from a Session and forwards input to the
+    worker. The map is not mirrored.
+    """
+    # Marks sources that are sessions (see SessionManager.sessionFor)
+    isSession = True
+
+    def __init__(self, master, profile=None):
+        super(RemoteSession, self).__init__()
+        self.master = master
+        self.profile = profile
+
+        self.linebuffers = {'main': linebuffer.Linebuffer()}
+        self.userStatus = colors.AString("")
+        self.lastLine = ""
+        self.promptLine = ""
+        self.lastLineCache = ansi.LineCache()
+        self.promptLineCache = ansi.LineCache()
+        self.bindings = keys.Bindings()
+        self.map = map.Map()
+
+        # The worker owns connection and timers
+        self.telnet = None
+        self.timersDue = False
+
+        self.process = None
+        self.commands = None
+        self.source = None
+
+        self.dispatcher = event.Dispatcher()
+        self.dispatcher.register(RemoteEvent, self.remoteEvent)
+        self.dispatcher.register(event.InputEvent, lambda ev: self.send(("input", ev.text, ev.display)))
+        self.dispatcher.register(event.LuaEvent, lambda ev: self.send(("lua", ev.code)))
+        self.dispatcher.register(event.GridResizeEvent, lambda ev: self.send(("resize", ev.w, ev.h)))
+
+    def getName(self):
+        return self.profile or "default"
+
+    name = property(getName)
+
+    def start(self):
+        """
+        Start the worker process and listen to its output.
+        """
+        commandsRecv, self.commands = context.Pipe(False)
+        outputRecv, outputSend = context.Pipe(False)
+
+        # The profile may ask for the grid size while it loads
+        screen = self.master.screen
+        size = (getattr(screen, "width", None) or 80, getattr(screen, "height", None) or 24)
+
+        self.process = context.Process(target=runWorker, args=(self.profile, commandsRecv, outputSend, size))
+        self.process.daemon = True
+        self.process.start()
+
+        # The worker's ends belong to the worker now, so that EOF is seen
+        # when it exits
+        commandsRecv.close()
+        outputSend.close()
+
+        self.source = ConnectionSource(outputRecv)
+        self.source.bind(self)
+        if self.master.reactor is not None:
+            self.master.reactor.add(self.source)
+        else:
+            self.source.start()
+
+    def send(self, message):
+        if self.commands is None:
+            return
+        try:
+            self.commands.send([message])
+        except (EOFError, IOError):
+            self.commands = None
+
+    def event(self, ev):
+        self.dispatcher.dispatch(ev)
+
+    def remoteEvent(self, ev):
+        for msg in ev.messages:
+            if msg[0] == "lines":
+                lb = self.linebuffers.get(msg[1])
+                if lb is None:
+                    lb = self.linebuffers[msg[1]] = linebuffer.Linebuffer()
+                lb.lines.extend([colors.AString(l) for l in msg[2]])
+            elif msg[0] == "prompt":
+                self.promptLine, self.lastLine = msg[1], msg[2]
+            elif msg[0] == "status":
+                self.userStatus = colors.AString(msg[1])
+            elif msg[0] == "bindings":
+                self.bindings = keys.Bindings()
+                for k in msg[1]:
+                    self.bindings.add(k, self.remoteBinding(k))
+            elif msg[0] == "log":
+                self.master.log(*msg[1:])
+            elif msg[0] == "screen":
+                luaScreen = self.master.screen.getLuaScreen(None)
+                if luaScreen is not None:
+                    getattr(luaScreen, msg[1])(*msg[2])
+            elif msg[0] == "mode":
+                self.put(event.ModeEvent(msg[1]))
+            elif msg[0] == "quit":
+                self.put(event.QuitEvent())
+            elif msg[0] == "closed":
+                self.commands = None
+                self.master.log("Worker of session {} exited".format(self.name), "info")
+
+    def remoteBinding(self, keys):
+        return lambda: self.send(("binding", keys))
+
+    def getLastLine(self):
+        return self.lastLineCache.parse(self.lastLine)
+    def getPromptLine(self):
+        promptLine = self.promptLine
+        if promptLine == "":
+            return self.getLastLine()
+        else:
+            return self.promptLineCache.parse(promptLine)
+
+    def flush(self):
+        pass
+
+    def destroy(self):
+        self.send(("quit",))
+        if self.process is not None:
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# Measure the cost of handing events from a producer thread (like a Telnet
+# source) to the main thread, once through Drain.put() and once through a
+# Channel. The consumer uses getBatch() in both cases. Reported are the time
+# the producer spends per event and the time per event from start until the
+# consumer has received everything.
+#
+#   python bench_channel.py [events]
+
+import sys
+sys.path = [".."] + sys.path
+
+import threading
+
+from mudblood import event
+from mudblood.timers import clock
+
+def produce(put, n, result):
+    evs = [event.RawEvent(b"You see nothing special.\n") for i in range(n)]
+    start = clock()
+    for ev in evs:
+        put(ev)
+    result.append(clock() - start)
+    put(event.DisconnectEvent())
+
+def consume(drain):
+    n = 0
+    while True:
+        for ev in drain.getBatch(1024, True, 1):
+            if isinstance(ev, event.DisconnectEvent):
+                return n
+            n += 1
+
+def run(n, channel):
+    drain = event.Drain()
+    put = drain.openChannel().put if channel else drain.put
+    result = []
+    producer = threading.Thread(target=produce, args=(put, n, result))
+
+    start = clock()
+    producer.start()
+    count = consume(drain)
+    elapsed = clock() - start
+    producer.join()
+
+    assert count == n
+    return result[0] / n, elapsed / n
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    for name, channel in [("Drain.put()", False), ("Channel.put()", True)]:
+        put, total = run(n, channel)
+        print("{:14} producer {:6.0f} ns/event, total {:6.0f} ns/event".format(
+            name, put * 1e9, total * 1e9))
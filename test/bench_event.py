@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Measure how fast the main thread can consume events from a Drain while a
+# producer thread floods it with RawEvents, once with get() per event (the
+# old main loop) and once with getBatch().
+#
+#   python bench_event.py [events] [batch size]
+
+import sys
+sys.path = [".."] + sys.path
+
+import threading
+
+from mudblood import event
+from mudblood.timers import clock
+
+def produce(drain, n):
+    for i in range(n):
+        drain.put(event.RawEvent(b"You see nothing special.\n"))
+    drain.put(event.DisconnectEvent())
+
+def consumeSingle(drain):
+    n = 0
+    while True:
+        ev = drain.get(True, 1)
+        while ev is not None:
+            if isinstance(ev, event.DisconnectEvent):
+                return n
+            n += 1
+            ev = drain.get(False)
+
+def consumeBatch(drain, batchSize):
+    n = 0
+    while True:
+        for ev in drain.getBatch(batchSize, True, 1):
+            if isinstance(ev, event.DisconnectEvent):
+                return n
+            n += 1
+
+def run(consume, n):
+    drain = event.Drain()
+    producer = threading.Thread(target=produce, args=(drain, n))
+
+    start = clock()
+    producer.start()
+    count = consume(drain)
+    elapsed = clock() - start
+    producer.join()
+
+    assert count == n
+    return n / elapsed
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    batchSize = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+
+    single = run(consumeSingle, n)
+    batch = run(lambda drain: consumeBatch(drain, batchSize), n)
+
+    print("get():      {:12.0f} events/s".format(single))
+    print("getBatch(): {:12.0f} events/s ({:.1f}x)".format(batch, batch / single))
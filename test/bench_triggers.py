@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Measure how many lines per second the recv triggers of a profile handle,
+# once with one Lua call per line (Lua.triggerRecv) and once with one call
+# per burst of lines (Lua.triggerRecvLines). Needs lupa.
+#
+#   python bench_triggers.py [profile] [bursts] [lines per burst]
+#
+# Without a profile, the default trigger set is used.
+
+import sys
+sys.path = [".."] + sys.path
+
+
+from mudblood import record
+from mudblood import session
+from mudblood import ansi
+from mudblood.timers import clock
+
+def burst(n):
+    parser = ansi.Ansi()
+    return [parser.parseToAString("\x1b[32mA goblin\x1b[0m arrives from the {}. ({})".format(
+        ["north", "south", "east", "west"][i % 4], i)) for i in range(n)]
+
+def run(lua, bursts, lines, batched):
+    data = burst(lines)
+
+    start = clock()
+    for i in range(bursts):
+        if batched:
+            lua.triggerRecvLines(data)
+        else:
+            for l in data:
+                lua.triggerRecv(l)
+    elapsed = clock() - start
+
+    return bursts * lines / elapsed
+
+if __name__ == "__main__":
+    profile = sys.argv[1] if len(sys.argv) > 1 else None
+    bursts = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    lines = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    master = record.HeadlessMaster()
+    master.session = session.Session(master, profile)
+    master.session.bind(master.drain)
+    master.session.start()
+
+    # Keep the echoed lines from piling up
+    master.session.echo = lambda *args, **kwargs: None
+
+    single = run(master.session.lua, bursts, lines, False)
+    batch = run(master.session.lua, bursts, lines, True)
+
+    master.session.destroy()
+
+    print("per line:  {:10.0f} lines/s".format(single))
+    print("per burst: {:10.0f} lines/s ({:.1f}x)".format(batch, batch / single))
@@ -8,11 +8,35 @@ import unittest
 import test_telnet
 import test_keys
 import test_map
+import test_reactor
+import test_aiotelnet
+import test_record
+import test_event
+import test_trace
+import test_timers
+import test_screen
+import test_colors
+import test_ansi
+import test_worker
+import test_main
+import test_session
 
 suite = unittest.TestSuite([
     test_telnet.suite,
     test_keys.suite,
     test_map.suite,
+    test_reactor.suite,
+    test_aiotelnet.suite,
+    test_record.suite,
+    test_event.suite,
+    test_trace.suite,
+    test_timers.suite,
+    test_screen.suite,
+    test_colors.suite,
+    test_ansi.suite,
+    test_worker.suite,
+    test_main.suite,
+    test_session.suite,
     ])
 
 runner = unittest.TextTestRunner()
@@ -0,0 +1,68 @@
+import unittest
+import socket
+
+try:
+    import asyncio
+    from mudblood import aiotelnet
+except ImportError:
+    asyncio = None
+
+from mudblood.telnet import *
+from mudblood import event
+
+@unittest.skipIf(asyncio is None, "asyncio not available")
+class TestTelnetProtocol(unittest.TestCase):
+    def setUp(self):
+        self.drain = event.Drain()
+        self.loopThread = aiotelnet.LoopThread()
+        self.loopThread.start()
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+
+        self.telnet = self.loopThread.connect(self.drain, "127.0.0.1", self.server.getsockname()[1], 5)
+        self.peer, _ = self.server.accept()
+        self.peer.settimeout(5)
+
+    def tearDown(self):
+        self.telnet.stop()
+        self.peer.close()
+        self.server.close()
+        self.loopThread.stop()
+
+    def test_receive(self):
+        self.peer.sendall(b"hello\n" + bytes(bytearray([IAC, WILL, OPT_EOR])))
+        self.assertEqual(self.drain.get(True, 5).data, b"hello\n")
+        self.assertEqual(self.drain.get(True, 5), TelnetEvent(WILL, OPT_EOR, None))
+
+        self.peer.close()
+        self.assertIsInstance(self.drain.get(True, 5), event.DisconnectEvent)
+
+    def test_send(self):
+        self.telnet.sendIAC(DO, OPT_EOR)
+        self.telnet.sendNaws(80, 24)
+        self.telnet.write(b"look\n")
+
+        expected = bytes(bytearray([IAC, DO, OPT_EOR, IAC, SB, OPT_NAWS, 0, 80, 0, 24, IAC, SE])) + b"look\n"
+        received = b""
+        while len(received) < len(expected):
+            received += self.peer.recv(1024)
+        self.assertEqual(received, expected)
+
+    def test_backpressure(self):
+        writer = self.telnet.file
+        self.loopThread.loop.call_soon_threadsafe(self.telnet.pause_writing)
+        self.telnet.write(b"queued\n")
+
+        f = asyncio.run_coroutine_threadsafe(asyncio.sleep(0.1), self.loopThread.loop)
+        f.result(5)
+        self.assertEqual(writer.backlogSize, 7)
+
+        self.loopThread.loop.call_soon_threadsafe(self.telnet.resume_writing)
+        self.assertEqual(self.peer.recv(1024), b"queued\n")
+        self.assertEqual(writer.backlogSize, 0)
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestTelnetProtocol]
+    ])
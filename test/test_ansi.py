@@ -0,0 +1,33 @@
+import unittest
+
+from mudblood import ansi
+from mudblood import colors
+
+class TestLineCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ansi.LineCache()
+
+    def parse(self, text):
+        return ansi.Ansi().parseToAString(text)
+
+    def test_append(self):
+        # The escape sequence is split between two updates
+        parts = ["> \x1b[3", "1mred", " text\x1b[0m plain"]
+        text = ""
+        for p in parts:
+            text += p
+            self.assertEqual(self.cache.parse(text).string, self.parse(text).string)
+        self.assertEqual(str(self.cache.parse(text)), "> red text plain")
+
+    def test_change(self):
+        self.cache.parse("\x1b[31mfoo")
+        self.assertEqual(self.cache.parse("bar").string, self.parse("bar").string)
+        self.assertEqual(self.cache.parse("").string, [])
+
+    def test_copy(self):
+        self.cache.parse("foo").fg(colors.RED)
+        self.assertEqual(self.cache.parse("foo").string, self.parse("foo").string)
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestLineCache]
+    ])
@@ -0,0 +1,17 @@
+import unittest
+
+from mudblood import colors
+
+class TestAString(unittest.TestCase):
+    def test_strip(self):
+        s = colors.AString("  ") + colors.AString("foo bar").fg(colors.RED) + colors.AString(" \t")
+        stripped = s.strip()
+        self.assertEqual(str(stripped), "foo bar")
+        self.assertEqual(stripped[0][0][0], colors.RED)
+        self.assertEqual(len(s), 11)
+
+        self.assertEqual(str(colors.AString("   ").strip()), "")
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestAString]
+    ])
@@ -0,0 +1,189 @@
+import unittest
+import time
+import threading
+
+from mudblood import event
+
+class TestDrain(unittest.TestCase):
+    def setUp(self):
+        self.drain = event.Drain()
+
+    def test_order(self):
+        for i in range(5):
+            self.drain.put(i)
+        self.drain.push(-1)
+
+        self.assertEqual(self.drain.getBatch(2), [-1, 0])
+        self.assertEqual(self.drain.drainAll(), [1, 2, 3, 4])
+        self.assertEqual(self.drain.drainAll(), [])
+        self.assertIsNone(self.drain.get(False))
+
+    def test_lanes(self):
+        raw = [event.RawEvent(b"line") for i in range(3)]
+        for r in raw:
+            self.drain.put(r)
+        log = event.LogEvent("log")
+        key = event.KeyEvent(ord("x"))
+        self.drain.put(log)
+        self.drain.put(key)
+
+        self.assertEqual(self.drain.drainAll(), [key, log] + raw)
+
+        stats = self.drain.laneStats()
+        self.assertEqual(stats["network"]["events"], 3)
+        self.assertEqual(stats["network"]["maxDepth"], 3)
+        self.assertEqual(stats["network"]["depth"], 0)
+        self.assertEqual(stats["input"]["events"], 1)
+
+    def test_aging(self):
+        drain = event.Drain(agingLimit=0.01)
+        raw = event.RawEvent(b"old")
+        drain.put(raw)
+        time.sleep(0.02)
+        key = event.KeyEvent(ord("x"))
+        drain.put(key)
+
+        self.assertEqual(drain.drainAll(), [raw, key])
+        self.assertTrue(drain.laneStats()["network"]["maxWait"] >= 0.01)
+
+    def test_aging_backlog(self):
+        drain = event.Drain(agingLimit=0.01)
+        key = event.KeyEvent(ord("x"))
+        drain.put(key)
+        raws = [event.RawEvent(b"new"), event.RawEvent(b"newer")]
+        for r in raws:
+            drain.put(r)
+        time.sleep(0.02)
+
+        # The raw events are older than agingLimit, but arrived after the key
+        self.assertEqual(drain.drainAll(), [key] + raws)
+
+    def test_coalesce(self):
+        from mudblood import telnet
+
+        drain = event.Drain(coalesce=True)
+        a, b = event.Source(), event.Source()
+        a.bind(drain)
+        b.bind(drain)
+
+        a.put(event.RawEvent(b"foo"))
+        a.put(event.RawEvent(b"bar", True))
+        a.put(event.RawEvent(b"prompt"))
+        a.put(telnet.TelnetEvent(telnet.WILL, telnet.OPT_ECHO))
+        a.put(event.RawEvent(b"baz"))
+        b.put(event.RawEvent(b"other"))
+        a.put(event.RawEvent(b"qux"))
+
+        evs = drain.drainAll()
+        self.assertEqual([(e.data, e.prompt) for e in evs if isinstance(e, event.RawEvent)],
+                         [(b"foobar", True), (b"prompt", False), (b"baz", False),
+                          (b"other", False), (b"qux", False)])
+        self.assertIsInstance(evs[2], telnet.TelnetEvent)
+        self.assertEqual(drain.laneStats()["network"]["coalesced"], 1)
+
+    def test_timeout(self):
+        self.assertEqual(self.drain.getBatch(None, True, 0.01), [])
+
+    def test_wait(self):
+        t = threading.Timer(0.01, self.drain.put, [42])
+        t.start()
+        self.assertEqual(self.drain.getBatch(), [42])
+        t.join()
+
+    def test_waker(self):
+        woken = []
+        self.drain.waker = lambda: woken.append(True)
+        self.drain.consumer = threading.current_thread()
+
+        self.drain.sleeping = True
+        self.drain.put(1)
+        self.assertEqual(woken, [])
+
+        t = threading.Thread(target=self.drain.put, args=[2])
+        t.start()
+        t.join()
+        self.assertEqual(woken, [True])
+
+        # Only while the consumer sleeps
+        self.drain.sleeping = False
+        t = threading.Thread(target=self.drain.put, args=[3])
+        t.start()
+        t.join()
+        self.assertEqual(woken, [True])
+        self.assertEqual(self.drain.drainAll(), [1, 2, 3])
+
+class TestChannel(unittest.TestCase):
+    def setUp(self):
+        self.drain = event.Drain()
+        self.channel = self.drain.openChannel(4)
+
+    def test_order(self):
+        # Wrap around the ring a few times
+        for n in range(3):
+            for i in range(4):
+                self.channel.put(i)
+            self.assertEqual(len(self.channel), 4)
+            self.assertEqual(self.drain.getBatch(None, False), [0, 1, 2, 3])
+        self.assertTrue(self.drain.empty())
+
+    def test_lanes(self):
+        self.channel.put(event.RawEvent(b"a"))
+        self.drain.put(event.KeyEvent(1))
+        evs = self.drain.getBatch(None, False)
+        self.assertIsInstance(evs[0], event.KeyEvent)
+        self.assertIsInstance(evs[1], event.RawEvent)
+
+    def test_close(self):
+        self.channel.put(1)
+        self.channel.close()
+        self.assertEqual(self.drain.get(False), 1)
+        self.assertEqual(self.drain.channels, [])
+
+    def test_wakeup(self):
+        t = threading.Timer(0.01, self.channel.put, [42])
+        t.start()
+        self.assertEqual(self.drain.getBatch(None, True, 5), [42])
+        t.join()
+
+    def test_full(self):
+        def produce():
+            for i in range(100):
+                self.channel.put(i)
+
+        t = threading.Thread(target=produce)
+        t.start()
+        received = []
+        while len(received) < 100:
+            received += self.drain.getBatch(None, True, 1)
+        t.join()
+        self.assertEqual(received, list(range(100)))
+        self.assertTrue(self.channel.stalls > 0)
+
+class TestDispatcher(unittest.TestCase):
+    def test_dispatch(self):
+        handled = []
+        d = event.Dispatcher()
+        d.register(event.Event, lambda ev: handled.append("event"))
+        d.register(event.RawEvent, lambda ev: handled.append(ev.data))
+
+        class PluginEvent(event.RawEvent):
+            __slots__ = ()
+
+        self.assertTrue(d.dispatch(event.RawEvent(b"raw")))
+        self.assertTrue(d.dispatch(PluginEvent(b"plugin")))
+        self.assertTrue(d.dispatch(event.QuitEvent()))
+        self.assertFalse(d.dispatch(42))
+
+        d.register(PluginEvent, lambda ev: handled.append("own"))
+        d.dispatch(PluginEvent(b"plugin"))
+        self.assertEqual(handled, [b"raw", b"plugin", "event", "own"])
+
+    def test_slots(self):
+        ev = event.RawEvent(b"data", True)
+        self.assertFalse(hasattr(ev, "__dict__"))
+        self.assertEqual(ev.fields(), {"source": None, "continuation": None,
+                                       "data": b"data", "prompt": True})
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestDrain, TestChannel, TestDispatcher]
+    ])
@@ -0,0 +1,54 @@
+import unittest
+import signal
+import threading
+
+try:
+    from mudblood import main
+except ImportError:
+    main = None
+
+from mudblood import screen
+from mudblood import event
+from mudblood import reactor
+from mudblood.timers import clock
+
+class InlineScreen(screen.Screen):
+    supportsInline = True
+
+@unittest.skipIf(main is None, "lupa not available")
+class TestSingleThreaded(unittest.TestCase):
+    def setUp(self):
+        self.master = main.Mudblood("none")
+        self.master.singleThreaded = True
+        self.master.reactor = reactor.Reactor()
+        self.master.drain.waker = self.master.reactor.wake
+        self.master.drain.consumer = threading.current_thread()
+        self.master.screen = InlineScreen(self.master)
+
+    def test_signal(self):
+        # Like the SIGWINCH handler of termbox, that reports a resize
+        def resize(signum, frame):
+            self.master.drain.put(event.ResizeEvent(100, 40))
+
+        old = signal.signal(signal.SIGALRM, resize)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            # Don't wait forever if the signal goes to another thread
+            deadline = clock() + 1
+            self.master.timers.add(deadline)
+            evs = []
+            while not evs and clock() < deadline:
+                evs = self.master.pollOnce(None)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old)
+
+        self.assertEqual([type(ev) for ev in evs], [event.ResizeEvent])
+
+        # The loop goes on
+        self.master.drain.put(event.LogEvent("still here"))
+        self.assertEqual([type(ev) for ev in self.master.pollOnce(None)], [event.LogEvent])
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestSingleThreaded]
+    ])
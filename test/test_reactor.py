@@ -0,0 +1,151 @@
+import unittest
+import socket
+import struct
+import errno
+import signal
+import threading
+
+from mudblood.telnet import *
+from mudblood import event
+from mudblood import reactor
+
+class FailingSource(event.AsyncSource):
+    def __init__(self, sock):
+        super(FailingSource, self).__init__()
+        self.socket = sock
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def poll(self):
+        raise socket.error(errno.ECONNRESET, "Connection reset by peer")
+
+class TestReactor(unittest.TestCase):
+    def connection(self):
+        sock = TCPSocket()
+        sock.socket.close()
+        sock.socket, peer = socket.socketpair()
+        self.peers.append(peer)
+
+        telnet = Telnet(sock)
+        telnet.bind(self.drain)
+        self.reactor.add(telnet)
+        return telnet, peer
+
+    def setUp(self):
+        self.drain = event.Drain()
+        self.reactor = reactor.Reactor()
+        self.peers = []
+
+    def tearDown(self):
+        for p in self.peers:
+            p.close()
+
+    def test_multiplex(self):
+        t1, p1 = self.connection()
+        t2, p2 = self.connection()
+
+        p1.sendall(b"one\n")
+        self.assertEqual(self.reactor.runOnce(1), 1)
+        ev = self.drain.get(False)
+        self.assertEqual(ev.data, b"one\n")
+        self.assertIs(ev.source, t1)
+
+        p2.sendall(b"two\n")
+        self.assertEqual(self.reactor.runOnce(1), 1)
+        ev = self.drain.get(False)
+        self.assertEqual(ev.data, b"two\n")
+        self.assertIs(ev.source, t2)
+
+    def test_disconnect(self):
+        t1, p1 = self.connection()
+        p1.close()
+        self.reactor.runOnce(1)
+        self.assertIsInstance(self.drain.get(False), event.DisconnectEvent)
+        self.assertFalse(t1.running)
+        self.assertEqual(self.reactor.sources, {})
+
+    def test_remove(self):
+        t1, p1 = self.connection()
+        self.reactor.applyPending()
+        self.reactor.remove(t1)
+        p1.sendall(b"ignored")
+        self.reactor.runOnce(0)
+        self.assertIsNone(self.drain.get(False))
+        self.assertEqual(self.reactor.sources, {})
+
+    def test_poll_error(self):
+        sock, peer = socket.socketpair()
+        self.peers += [sock, peer]
+        failing = FailingSource(sock)
+        failing.bind(self.drain)
+        self.reactor.add(failing)
+        t1, p1 = self.connection()
+
+        peer.sendall(b"x")
+        p1.sendall(b"still here\n")
+        self.assertEqual(self.reactor.runOnce(1), 2)
+
+        evs = self.drain.drainAll()
+        self.assertEqual([type(ev) for ev in evs if ev.source is failing],
+                         [event.LogEvent, event.DisconnectEvent])
+        self.assertEqual([ev.data for ev in evs if ev.source is t1], [b"still here\n"])
+        self.assertFalse(failing.running)
+        self.assertEqual(list(self.reactor.sources.values()), [t1])
+
+    def test_inline_reset(self):
+        # Like Mudblood.pollOnce in single threaded mode: the main thread
+        # runs the reactor and consumes the drain
+        self.drain.waker = self.reactor.wake
+        self.drain.consumer = threading.current_thread()
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        sock = TCPSocket()
+        sock.connect(*server.getsockname())
+        peer, addr = server.accept()
+        server.close()
+
+        telnet = Telnet(sock)
+        telnet.bind(self.drain)
+        self.reactor.add(telnet)
+
+        # Closing with a zero linger time sends a RST
+        peer.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        peer.close()
+
+        self.drain.sleeping = True
+        try:
+            self.reactor.runOnce(1)
+        finally:
+            self.drain.sleeping = False
+
+        evs = self.drain.getBatch(None, False)
+        self.assertIsInstance(evs[-1], event.DisconnectEvent)
+        self.assertFalse(telnet.running)
+        self.assertEqual(self.reactor.sources, {})
+        sock.socket.close()
+
+    def test_signal(self):
+        signals = []
+        old = signal.signal(signal.SIGALRM, lambda signum, frame: signals.append(signum))
+        try:
+            # The signal arrives while the reactor waits in select()
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            self.assertEqual(self.reactor.runOnce(0.5), 0)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old)
+        self.assertEqual(signals, [signal.SIGALRM])
+
+    def test_thread(self):
+        self.reactor.start()
+        t1, p1 = self.connection()
+        p1.sendall(b"threaded\n")
+        self.assertEqual(self.drain.get(True, 5).data, b"threaded\n")
+        self.reactor.stop()
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestReactor]
+    ])
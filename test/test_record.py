@@ -0,0 +1,89 @@
+import unittest
+import socket
+import tempfile
+import shutil
+import os
+import time
+
+from mudblood.telnet import *
+from mudblood import event
+from mudblood import record
+
+class TestRecord(unittest.TestCase):
+    chunks = [b"Welcome!\n", bytes(bytearray([IAC, WILL, OPT_EOR])), b"> ", b"You see a troll.\n"]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "test.mbr")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def events(self, file):
+        drain = event.Drain()
+        t = Telnet(file)
+        t.bind(drain)
+        t.running = True
+        while t.running:
+            t.poll()
+        ret = []
+        while True:
+            e = drain.get(False)
+            if e is None:
+                break
+            e.source = None
+            ret.append((e.__class__, e.fields()))
+        return ret
+
+    def makeRecording(self):
+        sock = TCPSocket()
+        sock.socket.close()
+        sock.socket, peer = socket.socketpair()
+        rsock = record.RecordingSocket(sock, record.Recorder(self.filename))
+
+        drain = event.Drain()
+        t = Telnet(rsock)
+        t.bind(drain)
+        for c in self.chunks:
+            peer.sendall(c)
+            t.poll()
+            time.sleep(0.01)
+        peer.close()
+        t.poll()
+
+    def test_roundtrip(self):
+        self.makeRecording()
+
+        f = open(self.filename, "rb")
+        self.assertEqual(f.read(len(record.MAGIC)), record.MAGIC)
+        f.close()
+
+        replay = record.ReplayFile(self.filename)
+        for c in self.chunks:
+            self.assertEqual(replay.read(1024), c)
+        self.assertIsNone(replay.read(1024))
+
+        self.assertEqual(self.events(record.ReplayFile(self.filename)),
+                         self.events(record.ReplayFile(self.filename, realtime=True, speed=10.0)))
+
+    def test_realtime(self):
+        self.makeRecording()
+
+        start = time.time()
+        self.events(record.ReplayFile(self.filename, realtime=True))
+        self.assertTrue(time.time() - start >= 0.02)
+
+    def test_benchmark(self):
+        self.makeRecording()
+        result = record.benchmark(self.filename)
+        self.assertEqual(result["bytes"], len(b"Welcome!\n> You see a troll.\n"))
+        self.assertEqual(result["events"], 5)
+
+    def test_invalid(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"garbage")
+        self.assertRaises(record.InvalidRecordingException, record.ReplayFile, self.filename)
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestRecord]
+    ])
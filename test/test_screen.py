@@ -0,0 +1,94 @@
+import unittest
+
+from mudblood import screen
+from mudblood import event
+from mudblood import reactor
+
+class RecordingScreen(screen.Screen):
+    supportsInline = True
+
+    def __init__(self, master):
+        super(RecordingScreen, self).__init__(master)
+        self.handled = []
+        self.frames.maxFps = 0
+
+    def screenEvent(self, ev):
+        self.handled.append(type(ev))
+        return super(RecordingScreen, self).screenEvent(ev)
+
+class InlineMaster(object):
+    def __init__(self):
+        self.singleThreaded = True
+        self.drain = event.Drain()
+        self.reactor = reactor.Reactor()
+        self.session = None
+
+class TestFrameScheduler(unittest.TestCase):
+    def setUp(self):
+        self.frames = screen.FrameScheduler(maxFps=10, degradeRate=100)
+
+    def test_collapse(self):
+        self.assertTrue(self.frames.request())
+        self.assertFalse(self.frames.request())
+        self.assertFalse(self.frames.request())
+
+        self.frames.begin(0, 1.0)
+        self.assertTrue(self.frames.request())
+        self.assertEqual(self.frames.stats()["rendered"], 1)
+        self.assertEqual(self.frames.stats()["dropped"], 2)
+
+    def test_pacing(self):
+        self.frames.begin(0, 1.0)
+        self.assertAlmostEqual(self.frames.delay(1.05), 0.05)
+        self.assertEqual(self.frames.delay(1.2), 0.0)
+
+        self.frames.maxFps = 0
+        self.assertEqual(self.frames.delay(1.0), 0.0)
+
+    def test_degrade(self):
+        self.assertFalse(self.frames.begin(0, 1.0))
+        self.assertFalse(self.frames.begin(5, 1.1))
+        self.assertTrue(self.frames.begin(100, 1.2))
+        self.assertFalse(self.frames.begin(100, 1.3))
+        self.assertEqual(self.frames.stats()["degraded"], 1)
+
+class TestInlineScreen(unittest.TestCase):
+    def setUp(self):
+        self.screen = RecordingScreen(InlineMaster())
+
+    def test_inline(self):
+        self.assertTrue(self.screen.inline)
+
+        self.screen.start()
+        self.assertFalse(self.screen.thread.is_alive())
+
+        # Frames are drawn by the master, not queued
+        self.screen.updateScreen()
+        self.assertTrue(self.screen.frames.pending)
+        self.assertTrue(self.screen.queue.empty())
+
+    def test_run_pending(self):
+        self.screen.key(1)
+        self.screen.setMode("normal")
+        self.screen.runPending()
+        self.assertEqual(self.screen.handled, [screen.KeyScreenEvent, screen.ModeScreenEvent])
+        self.assertTrue(self.screen.queue.empty())
+
+        self.screen.destroy()
+        self.screen.join()
+        self.assertEqual(self.screen.handled[-1], screen.DestroyScreenEvent)
+
+    def test_threaded(self):
+        self.screen.master.singleThreaded = False
+        s = RecordingScreen(self.screen.master)
+        self.assertFalse(s.inline)
+
+        s.start()
+        s.key(1)
+        s.destroy()
+        s.join()
+        self.assertEqual(s.handled, [screen.KeyScreenEvent, screen.DestroyScreenEvent])
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestFrameScheduler, TestInlineScreen]
+    ])
@@ -0,0 +1,141 @@
+import unittest
+
+try:
+    from mudblood import session
+except ImportError:
+    session = None
+
+from mudblood import event
+
+class FakeLua(object):
+    def __init__(self):
+        self.timerQueries = 0
+
+    def triggerTime(self):
+        self.timerQueries += 1
+
+class FakeSession(event.Source):
+    isSession = True
+
+    def __init__(self, master, profile=None):
+        super(FakeSession, self).__init__()
+        self.profile = profile
+        self.events = []
+        self.timersDue = False
+        self.lua = FakeLua()
+        self.destroyed = False
+
+    def start(self):
+        pass
+
+    def event(self, ev):
+        self.events.append(ev)
+
+    def flush(self):
+        pass
+
+    def destroy(self):
+        self.destroyed = True
+
+class FakeScreen(object):
+    width = 80
+    height = 24
+
+    def __init__(self):
+        self.changes = 0
+
+    def sessionChanged(self):
+        self.changes += 1
+
+    def updateScreen(self):
+        pass
+
+class FakeMaster(object):
+    def __init__(self):
+        self.drain = event.Drain()
+        self.screen = FakeScreen()
+
+@unittest.skipIf(session is None, "lupa not available")
+class TestSessionManager(unittest.TestCase):
+    def setUp(self):
+        self.Session = session.Session
+        session.Session = FakeSession
+
+        self.master = FakeMaster()
+        self.manager = session.SessionManager(self.master)
+        self.a = self.manager.open("a")
+        self.b = self.manager.open("b")
+
+    def tearDown(self):
+        session.Session = self.Session
+
+    def test_open(self):
+        self.assertIs(self.manager.active, self.a)
+        self.assertEqual(list(self.manager), [self.a, self.b])
+
+        # Every session learns the grid size
+        evs = self.master.drain.drainAll()
+        self.assertEqual([ev.source for ev in evs], [self.a, self.b])
+        self.assertEqual([(ev.w, ev.h) for ev in evs], [(80, 24), (80, 24)])
+
+    def test_routing(self):
+        self.master.drain.drainAll()
+
+        # A source bound to a session (like its Telnet) belongs to it
+        source = event.Source()
+        source.bind(self.b)
+        source.put(event.RawEvent(b"foo"))
+        ev = self.master.drain.get(False)
+        self.assertIs(ev.source, source)
+        self.assertIs(self.manager.sessionFor(ev), self.b)
+        self.assertFalse(self.manager.event(ev))
+        self.assertEqual(self.b.events, [ev])
+
+        # Everything else goes to the active session
+        ev = event.InputEvent("look")
+        self.assertIs(self.manager.sessionFor(ev), self.a)
+        self.assertTrue(self.manager.event(ev))
+        self.assertEqual(self.a.events, [ev])
+
+    def test_resize(self):
+        ev = event.GridResizeEvent(100, 40)
+        self.assertTrue(self.manager.event(ev))
+        self.assertEqual(self.a.events, [ev])
+        self.assertEqual(self.b.events, [ev])
+
+        # A session's own resize event is not broadcast
+        self.b.put(event.GridResizeEvent(100, 40))
+        ev = self.master.drain.drainAll()[-1]
+        self.a.events = []
+        self.b.events = []
+        self.manager.event(ev)
+        self.assertEqual(self.a.events, [])
+        self.assertEqual(self.b.events, [ev])
+
+    def test_timers(self):
+        self.b.timersDue = True
+        self.assertFalse(self.manager.triggerTime())
+        self.assertEqual((self.a.lua.timerQueries, self.b.lua.timerQueries), (0, 1))
+        self.assertFalse(self.b.timersDue)
+
+        self.a.timersDue = True
+        self.assertTrue(self.manager.triggerTime())
+        self.assertEqual((self.a.lua.timerQueries, self.b.lua.timerQueries), (1, 1))
+
+    def test_switch_close(self):
+        self.manager.switch(self.b)
+        self.assertIs(self.manager.active, self.b)
+        self.assertEqual(self.master.screen.changes, 1)
+
+        self.manager.close(self.b)
+        self.assertTrue(self.b.destroyed)
+        self.assertIs(self.manager.active, self.a)
+        self.assertEqual(list(self.manager), [self.a])
+
+        self.assertRaises(Exception, self.manager.close, self.a)
+        self.assertIs(self.manager.active, self.a)
+        self.assertFalse(self.a.destroyed)
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestSessionManager]
+    ])
@@ -1,6 +1,10 @@
 import unittest
 import collections
 import time
+import random
+import zlib
+import socket
+import threading
 
 from mudblood.telnet import *
 from mudblood import event
@@ -18,7 +22,7 @@ class DummyFile(object):
 class TestTelnegs(unittest.TestCase):
     def assertEventsEqual(self, ev1, ev2):
         self.assertIsInstance(ev1, ev2.__class__)
-        self.assertDictEqual(ev1.__dict__, ev2.__dict__)
+        self.assertDictEqual(ev1.fields(), ev2.fields())
 
     def assertDrainContents(self, events):
         i = 0
@@ -27,8 +31,8 @@ class TestTelnegs(unittest.TestCase):
             e.source = e2.source
             if not (isinstance(e2, e.__class__)):
                 self.fail("Event {}: Classes dont match. {} expected, but found {}".format(i, e, e2))
-            if not e2.__dict__ == e.__dict__:
-                self.fail("Event {}: Contents dont match. {} expected, but found {}.\nexpected:{}\nfound:{}".format(i, e, e2, e.__dict__, e2.__dict__))
+            if not e2.fields() == e.fields():
+                self.fail("Event {}: Contents dont match. {} expected, but found {}.\nexpected:{}\nfound:{}".format(i, e, e2, e.fields(), e2.fields()))
             i += 1
 
     def setUp(self):
@@ -52,9 +56,340 @@ class TestTelnegs(unittest.TestCase):
         self.telnet.poll()
         self.assertDrainContents([TelnetEvent(SB, 1, bytearray([2,3]))])
 
+    def test_text(self):
+        self.file.write(b"foo\r\nbar\x07\bz" + bytes(bytearray([IAC, EOR])) + b"baz")
+        self.telnet.poll()
+        self.assertDrainContents([event.RawEvent(b"foo\nbaz"),
+                                  TelnetEvent(EOR, None, None),
+                                  event.RawEvent(b"baz")])
+
+    def test_multibyte(self):
+        data = u"Gr\u00fc\u00dfe\n".encode("utf8")
+        self.file.write(data[:3])
+        self.telnet.poll()
+        self.file.write(data[3:])
+        self.telnet.poll()
+        self.assertDrainContents([event.RawEvent(data[:3]), event.RawEvent(data[3:])])
+
+    def test_native_prompt(self):
+        self.telnet.nativePrompts = True
+        self.file.write(b"hp: 10> " + bytes(bytearray([IAC, GA])) + b"foo" + bytes(bytearray([IAC, EOR, IAC, EOR])))
+        self.file.write(b"bar" + bytes(bytearray([IAC, DO, OPT_EOR])))
+        self.telnet.poll()
+        self.assertDrainContents([event.RawEvent(b"hp: 10> ", True),
+                                  event.RawEvent(b"foo", True),
+                                  event.RawEvent(b"", True),
+                                  event.RawEvent(b"bar"),
+                                  TelnetEvent(DO, OPT_EOR, None)])
+        self.assertIsNone(self.drain.get(False))
+
+    def test_gmcp(self):
+        self.file.write(bytearray([IAC, SB, 201]) + b'Char.Vitals {"hp": 10}' + bytearray([IAC, SE]))
+        self.file.write(bytearray([IAC, SB, 201]) + b'Broken.Module {nojson' + bytearray([IAC, SE]))
+        self.telnet.poll()
+
+        self.drain.get(False)
+        ev = self.drain.get(False)
+        self.assertEqual(ev.module, "Char.Vitals")
+        self.assertEqual(ev.payload, '{"hp": 10}')
+        self.assertEqual(ev.data, {"hp": 10})
+        self.assertIsNone(ev.payload)
+
+        self.drain.get(False)
+        ev = self.drain.get(False)
+        self.assertEqual(ev.module, "Broken.Module")
+        self.assertRaises(ValueError, getattr, ev, "data")
+
+        self.assertEqual(GMCPEvent(module="Core.Hello", obj={"client": "mudblood"}).dump(),
+                         'Core.Hello {"client": "mudblood"}')
+        self.assertEqual(GMCPEvent(data="Core.Ping").data, None)
+
     def tearDown(self):
         pass
 
+class TestParsers(unittest.TestCase):
+    """
+    Feed the same input into the chunk scanning and the byte-by-byte parser
+    and check that they emit the same events.
+    """
+    inputs = [
+        b"hello world\n",
+        b"line1\r\nline2\r\npartial",
+        b"back\b\bspace\n\b\b\b",
+        b"\x1b[31mred\x1b[0m\n\x00\x07\x80\xfe",
+        bytes(bytearray([IAC, WILL, OPT_EOR])) + b"prompt> " + bytes(bytearray([IAC, EOR])),
+        b"a" + bytes(bytearray([IAC, SB, OPT_NAWS, 0, 80, IAC, IAC, 0, 24, IAC, SE])) + b"b",
+        bytes(bytearray([IAC, SB, 201])) + b'Char.Vitals {"hp": 10}' + bytes(bytearray([IAC, SE])),
+        bytes(bytearray([IAC, NOP, IAC, 12, IAC])),
+        ]
+
+    def collect(self, fast, chunks, native=False):
+        drain = event.Drain()
+        telnet = Telnet(None, fastParser=fast)
+        telnet.nativePrompts = native
+        telnet.bind(drain)
+        for c in chunks:
+            telnet.parse(c)
+        ret = []
+        while True:
+            e = drain.get(False)
+            if e is None:
+                break
+            e.source = None
+            ret.append((e.__class__, e.fields()))
+        return ret
+
+    def test_equal(self):
+        data = b"".join(self.inputs)
+        for size in [1, 2, 3, 7, 16, len(data)]:
+            chunks = [data[i:i+size] for i in range(0, len(data), size)]
+            self.assertEqual(self.collect(True, chunks), self.collect(False, chunks))
+            self.assertEqual(self.collect(True, chunks, True), self.collect(False, chunks, True))
+
+    def test_random(self):
+        rnd = random.Random(4711)
+        for i in range(200):
+            data = bytes(bytearray([rnd.choice([IAC, SB, SE, WILL, GA, 201, 13, 10, 8, 27, 0, 200, 65, 66])
+                                    for j in range(rnd.randint(0, 64))]))
+            cuts = sorted(rnd.sample(range(len(data) + 1), min(3, len(data) + 1)))
+            chunks = [data[a:b] for a, b in zip([0] + cuts, cuts + [len(data)])]
+            self.assertEqual(self.collect(True, chunks), self.collect(False, chunks))
+            self.assertEqual(self.collect(True, chunks, True), self.collect(False, chunks, True))
+
+class TestMCCP(unittest.TestCase):
+    def events(self, chunks, fast=True):
+        drain = event.Drain()
+        telnet = Telnet(None, fastParser=fast)
+        telnet.bind(drain)
+        for c in chunks:
+            telnet.parse(c)
+        ret = []
+        while True:
+            e = drain.get(False)
+            if e is None:
+                break
+            if not isinstance(e, event.LogEvent):
+                ret.append(e)
+        return telnet, ret
+
+    def stream(self):
+        start = bytes(bytearray([IAC, SB, OPT_MCCP2, IAC, SE]))
+        payload = b"compressed line\n" * 20 + bytes(bytearray([IAC, EOR]))
+        return b"plain\n" + start + zlib.compress(payload) + b"after\n"
+
+    def check(self, telnet, evs):
+        # Merge consecutive RawEvents, chunking may split them arbitrarily
+        merged = []
+        for e in evs:
+            if isinstance(e, event.RawEvent) and merged and isinstance(merged[-1], bytes):
+                merged[-1] += e.data
+            elif isinstance(e, event.RawEvent):
+                merged.append(e.data)
+            else:
+                merged.append(e)
+
+        self.assertEqual(merged, [b"plain\n",
+                                  TelnetEvent(SB, OPT_MCCP2, bytearray()),
+                                  b"compressed line\n" * 20,
+                                  TelnetEvent(EOR, None, None),
+                                  b"after\n"])
+        self.assertIsNone(telnet.decompressor)
+
+        compressed, decompressed, ratio, saved = telnet.compressionStats()
+        self.assertEqual(decompressed, 20 * 16 + 2)
+        self.assertTrue(ratio > 1.0)
+        self.assertEqual(saved, decompressed - compressed)
+
+    def test_single_chunk(self):
+        for fast in [True, False]:
+            self.check(*self.events([self.stream()], fast))
+
+    def test_split(self):
+        data = self.stream()
+        for size in [1, 3, 10]:
+            chunks = [data[i:i+size] for i in range(0, len(data), size)]
+            self.check(*self.events(chunks))
+
+class TestTCPSocket(unittest.TestCase):
+    def setUp(self):
+        self.sock = TCPSocket()
+        self.sock.socket.close()
+        self.sock.socket, self.peer = socket.socketpair()
+
+    def tearDown(self):
+        self.sock.socket.close()
+        self.peer.close()
+
+    def test_readInto(self):
+        self.peer.sendall(b"x" * TCPSocket.MIN_READ)
+        self.assertEqual(self.sock.readInto(), TCPSocket.MIN_READ)
+        self.assertEqual(self.sock.readSize, 2 * TCPSocket.MIN_READ)
+
+        self.peer.sendall(b"y")
+        self.assertEqual(self.sock.readInto(), 1)
+        self.assertEqual(self.sock.buffer[:1], bytearray(b"y"))
+        self.assertEqual(self.sock.readSize, TCPSocket.MIN_READ)
+
+        self.peer.close()
+        self.assertIsNone(self.sock.readInto())
+
+    def test_poll(self):
+        drain = event.Drain()
+        telnet = Telnet(self.sock)
+        telnet.bind(drain)
+
+        self.peer.sendall(b"hello" + bytes(bytearray([IAC, EOR])) + b"world")
+        telnet.poll()
+        self.peer.close()
+        telnet.poll()
+
+        self.assertEqual(drain.get(False).data, b"hello")
+        self.assertEqual(drain.get(False), TelnetEvent(EOR, None, None))
+        self.assertEqual(drain.get(False).data, b"world")
+        self.assertIsInstance(drain.get(False), event.DisconnectEvent)
+
+class TestWriteQueue(unittest.TestCase):
+    def setUp(self):
+        self.file = DummyFile()
+        self.writes = []
+        write = self.file.write
+        def countingWrite(string):
+            self.writes.append(bytes(string))
+            write(string)
+        self.file.write = countingWrite
+
+        self.telnet = Telnet(self.file)
+        self.telnet.bind(event.Drain())
+
+    def test_unbuffered(self):
+        self.telnet.write(b"n\n")
+        self.telnet.write(b"s\n")
+        self.assertEqual(self.writes, [b"n\n", b"s\n"])
+
+    def test_coalesce(self):
+        self.telnet.buffered = True
+        self.telnet.write(b"n\n")
+        self.telnet.sendIAC(DO, OPT_EOR)
+        self.telnet.write(b"s\n")
+        self.assertEqual(self.writes, [])
+        self.assertEqual(self.telnet.queueDepth(), (3, 7))
+
+        self.telnet.flush()
+        self.assertEqual(self.writes, [b"n\n" + bytes(bytearray([IAC, DO, OPT_EOR])) + b"s\n"])
+        self.assertEqual(self.telnet.queueDepth(), (0, 0))
+        self.assertEqual(self.telnet.writeStats["flushes"], 1)
+        self.assertEqual(self.telnet.writeStats["writes"], 3)
+
+        self.telnet.flush()
+        self.assertEqual(len(self.writes), 1)
+
+    def test_sendall(self):
+        a, b = socket.socketpair()
+        sock = TCPSocket()
+        sock.socket.close()
+        sock.socket = a
+        data = b"x" * (1024 * 1024)
+
+        reader = threading.Thread(target=lambda: self.writes.append(self.recvAll(b, len(data))))
+        reader.start()
+        sock.write(data)
+        reader.join()
+        a.close()
+        b.close()
+        self.assertEqual(self.writes[-1], data)
+
+    def recvAll(self, sock, n):
+        ret = b""
+        while len(ret) < n:
+            ret += sock.recv(65536)
+        return ret
+
+class TestLatency(unittest.TestCase):
+    def setUp(self):
+        self.file = DummyFile()
+        self.sent = DummyFile()
+        self.file.write = self.sent.write
+        self.drain = event.Drain()
+        self.telnet = Telnet(self.file)
+        self.telnet.bind(self.drain)
+
+    def reply(self, cmd):
+        self.file.buffer += bytes(bytearray([IAC, cmd, OPT_TIMING_MARK]))
+        self.telnet.poll()
+
+    def test_ping(self):
+        self.assertIsNone(self.telnet.latencyStats())
+
+        self.telnet.ping()
+        self.telnet.ping()
+        self.assertEqual(self.sent.buffer, bytes(bytearray([IAC, DO, OPT_TIMING_MARK])) * 2)
+
+        self.reply(WILL)
+        self.reply(WONT)
+        for i in range(2):
+            ev = self.drain.get(False)
+            self.assertIsInstance(ev, LatencyEvent)
+            self.assertTrue(ev.rtt >= 0.0)
+        self.assertIsNone(self.drain.get(False))
+
+        count, mn, avg, p99, last = self.telnet.latencyStats()
+        self.assertEqual(count, 2)
+        self.assertTrue(mn <= avg <= p99)
+
+    def test_queued(self):
+        self.telnet.buffered = True
+        self.telnet.write(b"n\n")
+        self.telnet.ping()
+        self.assertEqual(self.sent.buffer, b"")
+
+        self.telnet.flush()
+        self.assertEqual(self.sent.buffer, b"n\n" + bytes(bytearray([IAC, DO, OPT_TIMING_MARK])))
+
+    def test_monitor(self):
+        self.telnet.running = True
+        monitor = LatencyMonitor(self.telnet, 0.01)
+        monitor.start()
+        ev = self.drain.get(True, 5)
+        monitor.stop()
+        monitor.thread.join()
+
+        # The ping is left to the consumer
+        self.assertIsInstance(ev, event.CallableEvent)
+        self.assertEqual(ev.call, self.telnet.ping)
+        self.assertEqual(self.sent.buffer, b"")
+
+    def test_unsolicited(self):
+        self.reply(WILL)
+        self.assertEqual(self.drain.get(False), TelnetEvent(WILL, OPT_TIMING_MARK, None))
+        self.assertIsNone(self.telnet.latencyStats())
+
+class ChunkFile(object):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+    def read(self, size):
+        return self.chunks.pop(0) if self.chunks else None
+    def write(self, string):
+        pass
+
+class TestChannel(unittest.TestCase):
+    def test_thread(self):
+        drain = event.Drain()
+        t = Telnet(ChunkFile([b"hello\n", b"world\n"]))
+        t.bind(drain)
+        t.channel = drain.openChannel()
+        t.start()
+        t.thread.join()
+
+        # Events from other threads bypass the channel
+        t.put(event.LogEvent("main", "debug"))
+
+        evs = drain.getBatch(None, False)
+        self.assertEqual([type(ev) for ev in evs],
+                [event.LogEvent, event.RawEvent, event.RawEvent, event.DisconnectEvent])
+        self.assertEqual(b"".join(ev.data for ev in evs[1:3]), b"hello\nworld\n")
+        self.assertIs(evs[1].source, t)
+        self.assertEqual(drain.channels, [])
+
 class TestReal(unittest.TestCase):
     def setUp(self):
         self.drain = event.Drain()
@@ -74,5 +409,5 @@ class TestReal(unittest.TestCase):
             print(e)
 
 suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
-    [TestTelnegs, TestReal]
+    [TestTelnegs, TestParsers, TestMCCP, TestTCPSocket, TestWriteQueue, TestLatency, TestChannel, TestReal]
     ])
@@ -0,0 +1,47 @@
+import unittest
+import sys
+import time
+
+from mudblood import timers
+
+class TestClock(unittest.TestCase):
+    def test_monotonic(self):
+        a = timers.clock()
+        b = timers.clock()
+        self.assertTrue(b >= a)
+
+        # clock_gettime is always available there
+        if sys.platform.startswith("linux"):
+            self.assertIsNot(timers.clock, time.time)
+
+class TestTimerHeap(unittest.TestCase):
+    def setUp(self):
+        self.heap = timers.TimerHeap()
+
+    def test_empty(self):
+        self.assertIsNone(self.heap.timeout())
+        self.assertEqual(self.heap.expire(), 0)
+
+    def test_order(self):
+        fired = []
+        self.heap.add(30.0, lambda: fired.append(30))
+        self.heap.add(10.0, lambda: fired.append(10))
+        self.heap.add(20.0)
+
+        self.assertEqual(self.heap.timeout(5.0), 5.0)
+        self.assertEqual(self.heap.expire(5.0), 0)
+        self.assertEqual(self.heap.expire(20.0), 2)
+        self.assertEqual(fired, [10])
+        self.assertEqual(self.heap.timeout(40.0), 0.0)
+        self.assertEqual(self.heap.expire(40.0), 1)
+        self.assertEqual(fired, [10, 30])
+        self.assertEqual(len(self.heap), 0)
+
+    def test_delay(self):
+        self.heap.addDelay(0.5)
+        t = self.heap.timeout()
+        self.assertTrue(0.4 < t <= 0.5)
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestClock, TestTimerHeap]
+    ])
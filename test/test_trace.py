@@ -0,0 +1,55 @@
+import unittest
+
+from mudblood import event
+from mudblood import trace
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        h = trace.Histogram()
+        for i in range(1, 1001):
+            h.record(i / 1000000.0)
+
+        self.assertEqual(h.count, 1000)
+        self.assertEqual(h.min, 1)
+        self.assertEqual(h.max, 1000)
+        self.assertEqual(h.percentile(5), 50)
+        for p in [50, 90, 99]:
+            self.assertAlmostEqual(h.percentile(p), p * 10, delta=p * 10 * 0.04)
+        self.assertEqual(h.percentile(100), 1000)
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.tracer = trace.enable()
+
+    def tearDown(self):
+        trace.disable()
+
+    def test_stages(self):
+        drain = event.Drain()
+        source = event.Source()
+        source.bind(drain)
+
+        source.put(event.RawEvent(b"foo"))
+        ev = drain.get(False)
+        trace.stamp(ev, "dispatch")
+        trace.stamp(ev, "dispatch")
+        trace.stamp(ev, "trigger")
+        trace.presented()
+
+        for stage in ["queue", "dispatch", "trigger", "present", "total"]:
+            self.assertEqual(self.tracer.histograms[("RawEvent", stage)].count, 1)
+
+        report = self.tracer.report()
+        self.assertIn("RawEvent", report)
+        self.assertIn("trigger", report)
+
+    def test_disabled(self):
+        trace.disable()
+        ev = event.RawEvent(b"foo")
+        trace.stamp(ev, "dispatch")
+        trace.presented()
+        self.assertIsNone(ev.trace)
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestHistogram, TestTracer]
+    ])
@@ -0,0 +1,161 @@
+import unittest
+
+from mudblood import worker
+from mudblood import linebuffer
+from mudblood import colors
+from mudblood import keys
+from mudblood import event
+
+class FakeSession(object):
+    def __init__(self):
+        self.linebuffers = {'main': linebuffer.Linebuffer()}
+        self.promptLine = ""
+        self.lastLine = ""
+        self.userStatus = colors.AString("")
+        self.bindings = keys.Bindings()
+
+class FakeLuaScreen(object):
+    def __init__(self):
+        self.calls = []
+
+    def windowVisible(self, name, value=None):
+        self.calls.append(("windowVisible", name, value))
+
+class FakeScreen(object):
+    def __init__(self):
+        self.luaScreen = FakeLuaScreen()
+
+    def getLuaScreen(self, lua):
+        return self.luaScreen
+
+class FakeMaster(object):
+    def __init__(self):
+        self.reactor = None
+        self.screen = FakeScreen()
+        self.logs = []
+
+    def log(self, msg, level="debug"):
+        self.logs.append((msg, level))
+
+class TestPublisher(unittest.TestCase):
+    def setUp(self):
+        self.session = FakeSession()
+        self.publisher = worker.Publisher()
+        # Initial state
+        self.publisher.updates(self.session)
+
+    def test_lines(self):
+        self.assertEqual(self.publisher.updates(self.session), [])
+
+        self.session.linebuffers['main'].echo(colors.AString("one\ntwo"))
+        self.session.linebuffers['main'].echo(colors.AString("three"))
+        updates = self.publisher.updates(self.session)
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0][:2], ("lines", "main"))
+        self.assertEqual(["".join(c[1] for c in l) for l in updates[0][2]], ["one", "two", "three"])
+
+        self.session.linebuffers['main'].echo(colors.AString("four"))
+        updates = self.publisher.updates(self.session)
+        self.assertEqual(len(updates[0][2]), 1)
+
+    def test_state(self):
+        self.session.lastLine = "> "
+        self.session.userStatus = colors.AString("HP: 100")
+        self.session.bindings.add((1, 2), "foo")
+        self.publisher.send(("log", "hello", "info"))
+
+        updates = self.publisher.updates(self.session)
+        self.assertEqual([u[0] for u in updates], ["log", "prompt", "status", "bindings"])
+        self.assertEqual(updates[1], ("prompt", "", "> "))
+        self.assertEqual(updates[3], ("bindings", ((1, 2),)))
+
+        self.assertEqual(self.publisher.updates(self.session), [])
+
+class TestLuaScreen(unittest.TestCase):
+    def setUp(self):
+        self.publisher = worker.Publisher()
+        self.screen = worker.WorkerScreen(self.publisher, 100, 40)
+        self.luaScreen = self.screen.getLuaScreen(None)
+
+    def test_size(self):
+        self.assertEqual(self.luaScreen.width(), 100)
+        self.assertEqual(self.luaScreen.height(), 40)
+
+    def test_windows(self):
+        self.assertTrue(self.luaScreen.windowVisible('main'))
+        self.assertFalse(self.luaScreen.windowVisible('map'))
+
+        self.luaScreen.windowVisible('map', True)
+        self.luaScreen.windowSize('map', 20)
+        self.assertTrue(self.luaScreen.windowVisible('map'))
+        self.assertEqual(self.luaScreen.windowSize('map'), 20)
+        self.assertEqual(self.publisher.messages, [
+            ("screen", "windowVisible", ('map', True)),
+            ("screen", "windowSize", ('map', 20))])
+
+class TestRemoteSession(unittest.TestCase):
+    def setUp(self):
+        self.master = FakeMaster()
+        self.remote = worker.RemoteSession(self.master, "someprofile")
+        self.sent = []
+        self.remote.send = self.sent.append
+
+    def apply(self, messages):
+        self.remote.event(worker.RemoteEvent(messages))
+
+    def test_mirror(self):
+        session = FakeSession()
+        publisher = worker.Publisher()
+
+        session.linebuffers['main'].echo(colors.AString("hello").fg(colors.RED))
+        session.linebuffers['log'] = linebuffer.Linebuffer()
+        session.linebuffers['log'].echo(colors.AString("debug"))
+        session.promptLine = "\x1b[32m>\x1b[0m "
+        session.userStatus = colors.AString("status")
+        self.apply(publisher.updates(session))
+
+        self.assertEqual(str(self.remote.linebuffers['main'].lines[0]), "hello")
+        self.assertEqual(self.remote.linebuffers['main'].lines[0][0][0][0], colors.RED)
+        self.assertEqual(str(self.remote.linebuffers['log'].lines[0]), "debug")
+        self.assertEqual(str(self.remote.getPromptLine()), "> ")
+        self.assertEqual(str(self.remote.userStatus), "status")
+
+    def test_forward(self):
+        self.remote.event(event.InputEvent("look"))
+        self.remote.event(event.LuaEvent("print(1)"))
+        self.remote.event(event.GridResizeEvent(80, 24))
+        self.assertEqual(self.sent, [("input", "look", True), ("lua", "print(1)"), ("resize", 80, 24)])
+
+    def test_screen(self):
+        self.apply([("screen", "windowVisible", ('map', False))])
+        self.assertEqual(self.master.screen.luaScreen.calls, [("windowVisible", 'map', False)])
+
+    def test_bindings(self):
+        self.apply([("bindings", ((1, 2),))])
+        self.assertEqual(self.remote.bindings.key(1), True)
+        binding = self.remote.bindings.key(2)
+        binding()
+        self.assertEqual(self.sent, [("binding", (1, 2))])
+
+    def test_messages(self):
+        drain = event.Drain()
+        self.remote.bind(drain)
+        self.apply([("log", "hi", "info"), ("quit",), ("closed",)])
+        self.assertEqual(self.master.logs[0], ("hi", "info"))
+        self.assertIsInstance(drain.get(False), event.QuitEvent)
+
+class TestConnectionSource(unittest.TestCase):
+    def test_pipe(self):
+        recv, send = worker.context.Pipe(False)
+        source = worker.ConnectionSource(recv)
+
+        send.send([("quit",)])
+        self.assertEqual(source.poll().messages, [("quit",)])
+
+        send.close()
+        self.assertEqual(source.poll().messages, [("closed",)])
+        self.assertFalse(source.running)
+
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in
+    [TestPublisher, TestLuaScreen, TestRemoteSession, TestConnectionSource]
+    ])